@@ -0,0 +1,310 @@
+"""
+Shared helpers of the bench_*.py scripts: synthetic traces, and running a snippet
+against the modules of a git revision so a change can be timed before and after.
+"""
+
+import atexit
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+from test_trace_reader import event
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LAUNCH = "cudaLaunchKernel"
+
+# Defined in every snippet run by runAt
+_PROLOGUE = """
+import json, resource, sys
+sys.path.insert(0, {path!r})
+sys.setrecursionlimit(1000000)
+def report(**values):
+    values["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(values))
+"""
+
+_checkouts = {}
+
+
+def checkout(rev):
+    """
+    Directory holding the files of a git revision, "." is the working tree.
+    Revisions are exported to a temporary directory once per run.
+    """
+    if rev == ".":
+        return REPO_DIR
+    if rev not in _checkouts:
+        archive = subprocess.run(
+            ["git", "-C", REPO_DIR, "archive", rev], check=True, capture_output=True
+        ).stdout
+        path = tempfile.mkdtemp(prefix="bench_")
+        atexit.register(shutil.rmtree, path, True)
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(path, filter="data")
+            else:
+                tar.extractall(path)
+        _checkouts[rev] = path
+    return _checkouts[rev]
+
+
+def runAt(rev, code):
+    """
+    Runs code in a new Python process that imports the modules of rev. The code
+    calls report(**values), the values are returned with the peak RSS of the process
+    in MiB as "rss". Anything else the code prints is ignored.
+    """
+    path = checkout(rev)
+    result = subprocess.run(
+        [sys.executable, "-c", _PROLOGUE.format(path=path) + code],
+        cwd=path,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def generate(writer, *args):
+    """
+    Calls writer(*args), one of the write* functions of this module, in a new
+    process. Linux carries the peak RSS of a process over to the children it forks,
+    building the data in the bench process itself would inflate what runAt reports.
+    """
+    runAt(
+        ".", f"import bench_common\nbench_common.{writer.__name__}(*{args!r})\nreport()"
+    )
+
+
+def writeTorchTrace(path, steps, ops_per_step, seed=0):
+    """
+    PyTorch like chrome trace: a ProfilerStep#N per step holding ops_per_step cpu_ops,
+    each launching 0-3 kernels (cudaLaunchKernel, correlation ids and s/f flow
+    events), some launches inside a nested cpu_op. 40 steps of 2000 ops are about
+    75 MB and 595k events.
+    """
+    rnd = random.Random(seed)
+    events = []
+    correlation = 0
+    t = 1000
+    names = "aten::add aten::mul aten::mm aten::relu aten::linear aten::copy_".split()
+    kernels = [
+        "void at::native::elementwise_kernel<128, 2, at::native::CUDAFunctor_add<float> >(int)",
+        "void at::native::vectorized_elementwise_kernel<4, at::native::BinaryFunctor<float, "
+        "float, float, at::native::MulFunctor<float> > >(int)",
+        "Cijk_Ailk_Bljk_SB_MT64x64",
+        "ampere_sgemm_128x64_nn",
+        "Memset (Device)",
+    ]
+    dims = {"Input Dims": [[4, 8], [4, 8]]}
+    for step in range(steps):
+        step_start = t
+        step_events = []
+        t += 5
+        for _ in range(ops_per_step):
+            name = rnd.choice(names)
+            op_start = t
+            t += 2
+            inner = []
+            for _ in range(rnd.randint(0, 3)):
+                inner_name = rnd.choice(names) if rnd.random() < 0.3 else None
+                if inner_name:
+                    inner.append(
+                        event("X", "cpu_op", inner_name, 1, 1, t, dur=3, args=dict(dims))
+                    )
+                    t += 4
+                correlation += 1
+                kernel_ts = t + rnd.randint(1, 50)
+                kernel = rnd.choice(kernels)
+                cat = "gpu_memset" if kernel.startswith("Memset") else "kernel"
+                dur = rnd.randint(1, 20)
+                ids = {"correlation": correlation}
+                kernel_args = {**ids, "stream": 7}
+                inner += [
+                    event("X", "cuda_runtime", LAUNCH, 1, 1, t, dur=2, args=ids),
+                    event("X", cat, kernel, 0, 7, kernel_ts, dur=dur, args=kernel_args),
+                    event("s", "ac2g", "ac2g", 1, 1, t, id=correlation),
+                    event("f", "ac2g", "ac2g", 0, 7, kernel_ts, id=correlation, bp="e"),
+                ]
+                t += 3
+            t += 1
+            step_events.append(
+                event(
+                    "X", "cpu_op", name, 1, 1, op_start, dur=t - op_start, args=dict(dims)
+                )
+            )
+            step_events += inner
+            t += 1
+        t += 5
+        name = f"ProfilerStep#{step}"
+        events.append(
+            event(
+                "X",
+                "user_annotation",
+                name,
+                1,
+                1,
+                step_start,
+                dur=t - step_start,
+                args={},
+            )
+        )
+        events += step_events
+        t += 10
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "schemaVersion": 1,
+                "deviceProperties": [{"id": 0}],
+                "traceEvents": events,
+                "traceName": "x",
+                "baseTimeNanoseconds": 123,
+            },
+            f,
+        )
+
+
+def writeRpd(path, steps, ops_per_step, gpus, seed=0):
+    """
+    rocpd sqlite file: an iteration# UserMarker per step holding ops_per_step
+    UserMarker ops, each launching 1-3 kernels or copies on random GPUs, with some
+    hipMalloc/hipFree and one hsa api per launch. 200 steps of 1000 ops on 4 GPUs
+    are 820k apis and 400k ops.
+    """
+    rnd = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE rocpd_string(id integer primary key, string varchar(4096));
+        CREATE TABLE rocpd_api(id integer primary key, pid integer, tid integer,
+            start integer, end integer, apiName_id integer, args_id integer);
+        CREATE TABLE rocpd_op(id integer primary key, gpuId integer, queueId integer,
+            sequenceId integer, completionSignal varchar(18), start integer,
+            end integer, description_id integer, opType_id integer);
+        CREATE TABLE rocpd_api_ops(id integer primary key, api_id integer,
+            op_id integer);
+        CREATE TABLE rocpd_hsaApi(id integer primary key, pid integer, tid integer,
+            start integer, end integer, apiName_id integer, args_id integer);
+        CREATE TABLE rocpd_metadata(id integer primary key, tag varchar(4096),
+            value varchar(4096));
+        """)
+    strings = {}
+
+    def stringId(string):
+        if string not in strings:
+            strings[string] = len(strings) + 1
+            db.execute(
+                "insert into rocpd_string values (?, ?)", (strings[string], string)
+            )
+        return strings[string]
+
+    stringId("")
+    apis, ops, api_ops, hsa_apis = [], [], [], []
+    pointers = []
+    kernels = [
+        "Cijk_Ailk_Bljk_SB_MT64x64",
+        "void at::native::elementwise_kernel<128, 2, at::native::CUDAFunctor_add<float> >(int)",
+        "ampere_x",
+    ]
+    launches = ["hipLaunchKernel", "hipExtModuleLaunchKernel", "hipMemcpyAsync"]
+    gpu_free = [0] * gpus
+    marker = stringId("UserMarker")
+    t = 1_000_000
+    for step in range(steps):
+        step_api = [None, 100, 100, t, None, marker, stringId(f"iteration{step}")]
+        apis.append(step_api)
+        t += 5000
+        for _ in range(ops_per_step):
+            name = rnd.choice(["aten::add", "aten::mm", "aten::relu"])
+            op_api = [None, 100, 100, t, None, marker, stringId(name)]
+            apis.append(op_api)
+            t += 1000
+            for k in range(rnd.randint(1, 3)):
+                gpu = rnd.randrange(gpus)
+                launch = rnd.choice(launches)
+                apis.append(
+                    [
+                        None,
+                        100,
+                        100 + (k == 2),
+                        t,
+                        t + 2000,
+                        stringId(launch),
+                        stringId('args "q"'),
+                    ]
+                )
+                op_start = max(t + rnd.randint(1000, 40000), gpu_free[gpu])
+                op_end = op_start + rnd.randint(1000, 30000)
+                gpu_free[gpu] = op_end
+                if launch == "hipMemcpyAsync":
+                    op_type, description = "CopyHostToDevice", ""
+                else:
+                    op_type, description = "KernelExecution", rnd.choice(kernels)
+                queue = rnd.randrange(2)
+                ops.append(
+                    [
+                        None,
+                        gpu,
+                        queue,
+                        0,
+                        "",
+                        op_start,
+                        op_end,
+                        stringId(description),
+                        stringId(op_type),
+                    ]
+                )
+                api_ops.append((len(apis), len(ops)))
+                t += 3000
+                if rnd.random() < 0.3:
+                    pointer = hex(rnd.randrange(1 << 40))
+                    pointers.append(pointer)
+                    args = f"ptr({pointer}) size({hex(rnd.randrange(1, 1 << 24))})"
+                    apis.append(
+                        [
+                            None,
+                            100,
+                            100,
+                            t,
+                            t + 100,
+                            stringId("hipMalloc"),
+                            stringId(args),
+                        ]
+                    )
+                    t += 200
+                if pointers and rnd.random() < 0.25:
+                    pointer = pointers.pop(rnd.randrange(len(pointers)))
+                    args = f"ptr({pointer})"
+                    apis.append(
+                        [None, 100, 100, t, t + 100, stringId("hipFree"), stringId(args)]
+                    )
+                    t += 200
+                hsa = stringId("hsa_signal_store")
+                hsa_apis.append((None, 100, 101, t, t + 500, hsa, stringId("sig")))
+            t += 500
+            op_api[4] = t
+            t += 500
+        apis.append([None, 100, 100, t, t, marker, stringId(f"mark {step}")])
+        t += 1000
+        step_api[4] = t
+        t += 2000
+    for i, api in enumerate(apis):
+        api[0] = i + 1
+    for i, op in enumerate(ops):
+        op[0] = i + 1
+    db.executemany("insert into rocpd_api values (?,?,?,?,?,?,?)", apis)
+    db.executemany("insert into rocpd_op values (?,?,?,?,?,?,?,?,?)", ops)
+    db.executemany(
+        "insert into rocpd_api_ops values (?,?,?)",
+        [(i + 1, api, op) for i, (api, op) in enumerate(api_ops)],
+    )
+    db.executemany("insert into rocpd_hsaApi values (?,?,?,?,?,?,?)", hsa_apis)
+    db.commit()
+    db.close()
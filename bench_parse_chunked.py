@@ -0,0 +1,83 @@
+import argparse
+import os
+import tempfile
+
+from bench_common import generate, runAt, writeTorchTrace
+
+# The ranges are parsed one after the other, the multi-core time of parseTraceChunked
+# is estimated as split + slowest range + merge
+PARSE = """
+import os, time
+import trace_reader
+start = time.perf_counter()
+trace_reader.parseTrace({path!r})
+values = {{"serial": time.perf_counter() - start}}
+if hasattr(trace_reader, "parseTraceChunked"):
+    from trace_utils import pausedGC
+    size = os.path.getsize({path!r})
+    for workers in {workers!r}:
+        start = time.perf_counter()
+        first = trace_reader._eventsStart({path!r})
+        with open({path!r}, "rb") as f:
+            starts = [first]
+            for i in range(1, workers):
+                offset = first + (size - first) * i // workers
+                boundary = trace_reader._nextBoundary(f, offset, size)
+                if starts[-1] < boundary < size:
+                    starts.append(boundary)
+        split = time.perf_counter() - start
+        ranges = []
+        slowest = 0
+        for begin, end in zip(starts, starts[1:] + [size]):
+            start = time.perf_counter()
+            ranges.append(trace_reader._parseRange({path!r}, begin, end))
+            slowest = max(slowest, time.perf_counter() - start)
+        start = time.perf_counter()
+        with pausedGC():
+            trace = trace_reader.ParsedTrace()
+            for columns, _, _ in ranges:
+                trace.extend(columns)
+        merge = time.perf_counter() - start
+        values[str(workers)] = [split, slowest, merge]
+report(**values)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serial and estimated parallel trace parsing times at git revisions."
+    )
+    parser.add_argument(
+        "--rev",
+        action="append",
+        help="git revision to run, repeat to compare (default: the working tree)",
+    )
+    parser.add_argument(
+        "--trace", help="trace to parse, default: a synthetic --steps x --ops trace"
+    )
+    parser.add_argument("--steps", type=int, default=40)
+    parser.add_argument("--ops", type=int, default=2000, help="cpu ops per step")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8, 16])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.trace
+        if path is None:
+            path = os.path.join(tmp, "trace.json")
+            generate(writeTorchTrace, path, args.steps, args.ops)
+        path = os.path.abspath(path)
+        for rev in args.rev or ["."]:
+            result = runAt(rev, PARSE.format(path=path, workers=args.workers))
+            print(f"{rev:>12}  serial      {result['serial']:6.2f}s")
+            for workers in args.workers:
+                if str(workers) not in result:
+                    continue
+                split, slowest, merge = result[str(workers)]
+                print(
+                    f"{rev:>12}  workers {workers:3} {split + slowest + merge:6.2f}s"
+                    f"  (split {split:.2f}s, slowest range {slowest:.2f}s,"
+                    f" merge {merge:.2f}s)"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+from bench_common import generate, runAt, writeRpd
+
+# Runs the script like the command line does, so module level code counts too
+CONVERT = """
+import runpy, sys, time
+sys.argv = ["rpd2tracing.py", {rpd!r}, {output!r}]
+start = time.perf_counter()
+runpy.run_path("rpd2tracing.py", run_name="__main__")
+report(seconds=time.perf_counter() - start)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time of rpd2tracing.py at git revisions, best of --repeat runs."
+    )
+    parser.add_argument(
+        "--rev",
+        action="append",
+        help="git revision to run, repeat to compare (default: the working tree)",
+    )
+    parser.add_argument(
+        "--rpd", help="rpd to convert, default: a synthetic --steps x --ops rpd"
+    )
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--ops", type=int, default=1000, help="ops per step")
+    parser.add_argument("--gpus", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--gz",
+        action="store_true",
+        help="also time the .json.gz output, which older revisions write uncompressed",
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        source = args.rpd
+        if source is None:
+            source = os.path.join(tmp, "source.rpd")
+            generate(writeRpd, source, args.steps, args.ops, args.gpus)
+        rpd = os.path.join(tmp, "trace.rpd")
+        outputs = ["trace.json"] + ["trace.json.gz"] * args.gz
+        for output in outputs:
+            output = os.path.join(tmp, output)
+            revs = args.rev or ["."]
+            seconds = {rev: [] for rev in revs}
+            # Revisions take turns, so a slower period of the machine hits them all
+            for _ in range(args.repeat):
+                for rev in revs:
+                    # Some revisions add indexes to the rpd they read
+                    shutil.copyfile(source, rpd)
+                    code = CONVERT.format(rpd=rpd, output=output)
+                    seconds[rev].append(runAt(rev, code)["seconds"])
+            rows = None
+            if not output.endswith(".gz"):
+                with open(output, "rb") as f:
+                    rows = sum(1 for _ in f)
+            for rev in revs:
+                best = min(seconds[rev])
+                line = f"{rev:>12}  {os.path.basename(output):13} {best:6.2f}s"
+                if rows is not None:
+                    line += f"  {rows / best / 1000:4.0f}k rows/s"
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import random
+import time
+
+from trace_graph import Graph
+from test_trace_graph import nestedIntervals, opNode
+
+
+def randomIntervals(count, seed=0):
+    """
+    About count nested intervals (see test_trace_graph.nestedIntervals) in start order.
+    """
+    rnd = random.Random(seed)
+    intervals = []
+    start = 0
+    while len(intervals) < count:
+        end = start + rnd.randint(1000, 100000)
+        intervals.append((start, end - start))
+        nestedIntervals(rnd, start, end, 5, intervals)
+        start = end
+    intervals = intervals[:count]
+    intervals.sort(key=lambda interval: interval[0])
+    return intervals
+
+
+def timeBuild(intervals, batch):
+    nodes = [opNode("op", start, duration) for start, duration in intervals]
+    g = Graph()
+    t = time.perf_counter()
+    if batch:
+        g.addNodes(nodes)
+    else:
+        for node in nodes:
+            g.addNode(node)
+    return time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Graph.addNodes vs an addNode loop.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument(
+        "--max-addnode",
+        type=int,
+        default=10000,
+        help="Largest size the (slow) addNode loop is timed on.",
+    )
+    args = parser.parse_args()
+    for size in args.sizes:
+        intervals = randomIntervals(size)
+        line = f"{size:>8}  addNodes {timeBuild(intervals, True):8.2f}s"
+        if size <= args.max_addnode:
+            line += f"  addNode loop {timeBuild(intervals, False):8.2f}s"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import argparse
+
+from bench_common import runAt
+
+# Decoded like the reader does, so every node gets its own event dict and strings
+BUILD = """
+import gc, json, tracemalloc
+from trace_graph import Node
+count = {count}
+texts = [
+    json.dumps({{
+        "ph": "X", "cat": "cpu_op", "name": "aten::add" if i % 2 else "cudaLaunchKernel",
+        "pid": 1, "tid": 1, "ts": i * 10, "dur": 5,
+        "args": {{"External id": i, "Input Dims": [[4, 8], [4, 8]],
+                 "Input type": ["float", "float"], "Sequence number": i,
+                 "Fwd thread id": 0, "Record function id": 0}},
+    }})
+    for i in range(count)
+]
+tracemalloc.start()
+nodes = [Node(json.loads(text)) for text in texts]
+gc.collect()
+retained = tracemalloc.get_traced_memory()[0]
+report(retained=retained)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Memory retained per Node built from a decoded trace event."
+    )
+    parser.add_argument(
+        "--rev",
+        action="append",
+        help="git revision to run, repeat to compare (default: the working tree)",
+    )
+    parser.add_argument("--count", type=int, default=500000, help="cpu_op events")
+    args = parser.parse_args()
+    for rev in args.rev or ["."]:
+        retained = runAt(rev, BUILD.format(count=args.count))["retained"]
+        print(
+            f"{rev:>12}  {retained / args.count:6.0f} B/node"
+            f"  {retained / 2**20:6.0f} MiB for {args.count} nodes"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import os
+import tempfile
+
+from bench_common import generate, runAt, writeTorchTrace
+
+LOAD = """
+import time
+import trace_analyzer
+start = time.perf_counter()
+trace_analyzer.processJson({path!r}, {iteration!r})
+report(seconds=time.perf_counter() - start)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time and peak RSS of trace_analyzer.processJson at git revisions."
+    )
+    parser.add_argument(
+        "--rev",
+        action="append",
+        help="git revision to run, repeat to compare (default: the working tree)",
+    )
+    parser.add_argument(
+        "--trace", help="trace to load, default: a synthetic --steps x --ops trace"
+    )
+    parser.add_argument("--steps", type=int, default=40)
+    parser.add_argument("--ops", type=int, default=2000, help="cpu ops per step")
+    parser.add_argument(
+        "--iterations",
+        nargs="+",
+        default=["17", "None"],
+        help="iteration windows to load, None for the whole trace",
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.trace
+        if path is None:
+            path = os.path.join(tmp, "trace.json")
+            generate(writeTorchTrace, path, args.steps, args.ops)
+        path = os.path.abspath(path)
+        for iteration in args.iterations:
+            window = None if iteration == "None" else int(iteration)
+            for rev in args.rev or ["."]:
+                result = runAt(rev, LOAD.format(path=path, iteration=window))
+                print(
+                    f"{rev:>12}  iteration {iteration:>4}  {result['seconds']:6.2f}s"
+                    f"  {result['rss']:5.0f} MiB peak RSS"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import os
+import tempfile
+
+from bench_common import generate, runAt, writeTorchTrace
+
+# Same keys as the xlsx report: every op of the graph by short name
+VARIATIONS = """
+import time
+import trace_analyzer
+from trace_utils import shortName
+g = trace_analyzer.processJson({path!r}, None)
+keys = g.getNames(True, shortName)
+start = time.perf_counter()
+trace_analyzer.getAllVariations(g, keys)
+report(seconds=time.perf_counter() - start, nodes=len(g.toList()))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time of trace_analyzer.getAllVariations at git revisions."
+    )
+    parser.add_argument(
+        "--rev",
+        action="append",
+        help="git revision to run, repeat to compare (default: the working tree)",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        nargs="+",
+        default=[5, 20, 40, 80, 320, 1280],
+        help="trace sizes, in steps of --ops cpu ops",
+    )
+    parser.add_argument("--ops", type=int, default=40, help="cpu ops per step")
+    parser.add_argument(
+        "--limit",
+        type=float,
+        default=60,
+        help="skip the larger traces of a revision once it took more seconds than this",
+    )
+    args = parser.parse_args()
+    revs = args.rev or ["."]
+    slow = set()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "trace.json")
+        for steps in args.steps:
+            generate(writeTorchTrace, path, steps, args.ops)
+            for rev in revs:
+                if rev in slow:
+                    print(f"{rev:>12}  steps {steps:5}  skipped")
+                    continue
+                result = runAt(rev, VARIATIONS.format(path=path))
+                print(
+                    f"{rev:>12}  steps {steps:5}  nodes {result['nodes']:7}"
+                    f"  {result['seconds']:8.3f}s"
+                )
+                if result["seconds"] > args.limit:
+                    slow.add(rev)
+
+
+if __name__ == "__main__":
+    main()
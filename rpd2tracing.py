@@ -10,63 +10,175 @@ import sys
 import os
 import csv
 import re
+import io
+import gzip
+import json
 import sqlite3
+import heapq
+import shutil
+import tempfile
+import pathlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
 from datetime import datetime
 import argparse
 
 parser = argparse.ArgumentParser(description='convert RPD to json for chrome tracing')
 parser.add_argument('input_rpd', type=str, help="input rpd db")
-parser.add_argument('output_json', type=str, help="chrome tracing json output")
+parser.add_argument('output_json', type=str, help="chrome tracing json output, gzip compressed if it ends in .gz")
 parser.add_argument('--start', type=int, help="start timestamp")
 parser.add_argument('--end', type=int, help="end timestamp")
 parser.add_argument('--format', type=str, default="array", help="chome trace format, array or object")
+parser.add_argument('--index', action='store_true', help="create the indexes used by --start/--end and the GPU frames in the input rpd (it grows by about 50%%)")
+parser.add_argument('--index-db', type=str, help="copy the rpd to this file and create the indexes there, so the input rpd stays untouched")
+parser.add_argument('--no-index', action='store_true', help="don't create any index, even with --index or --index-db. Without them no index is created and the input rpd is only read")
+parser.add_argument('--memory-resolution', type=int, default=0, help="one Allocated Memory sample (the peak) per this many us instead of one per malloc/free")
+parser.add_argument('--workers', type=int, default=1, help="number of processes writing the sections of the output in parallel")
+parser.add_argument('--tmp-dir', type=str, help="directory of the temporary section files written with --workers, default: next to the output")
 args = parser.parse_args()
 
 print(args)
 
 connection = sqlite3.connect(args.input_rpd)
+dbPath = args.input_rpd
+
+# Covering indexes for --start/--end: every windowed query is a range on a raw start
+# column (plus the api_ops joins), without them each query scans the whole table.
+# The "distinct" queries below are "not indexed" to keep the first seen order
+rangeIndexes = [
+    ("rpd2tracing_api_start", "rocpd_api(start, end, pid, tid, apiName_id, args_id)"),
+    ("rpd2tracing_op_start", "rocpd_op(start, end, gpuId, queueId, opType_id, description_id)"),
+    ("rpd2tracing_api_ops_api", "rocpd_api_ops(api_id, op_id)"),
+    ("rpd2tracing_api_ops_op", "rocpd_api_ops(op_id, api_id)"),
+    ("rpd2tracing_hsa_start", "rocpd_hsaApi(start, end, pid, tid, apiName_id, args_id)"),
+]
+
+# The GPU frames read rocpd_api in start order and its api_ops by api_id, these two
+# are also created without --start/--end so that pass is not a full sort
+frameIndexes = ["rpd2tracing_api_start", "rpd2tracing_api_ops_api"]
+
+# Indexes are only created on request, by default the input is left as it is (its
+# size and mtime are what cached results are keyed on). Existing ones are still used
+if args.no_index or not (args.index or args.index_db):
+    wantedIndexes = []
+elif args.start or args.end:
+    wantedIndexes = rangeIndexes
+else:
+    wantedIndexes = [index for index in rangeIndexes if index[0] in frameIndexes]
+
+if wantedIndexes:
+    if args.index_db:
+        # Indexes live in the same db as their table, so the side db is a copy. It is
+        # kept and reused as long as it is newer than the input
+        if not os.path.exists(args.index_db) or os.path.getmtime(args.index_db) < os.path.getmtime(args.input_rpd):
+            print("Copying %s to %s"%(args.input_rpd, args.index_db))
+            side = sqlite3.connect(args.index_db)
+            connection.backup(side)
+            side.close()
+        connection.close()
+        connection = sqlite3.connect(args.index_db)
+        dbPath = args.index_db
+    for name, columns in wantedIndexes:
+        try:
+            if connection.execute("select 1 from sqlite_master where type = 'index' and name = ?", (name,)).fetchone() is None:
+                print("Creating index %s on %s"%(name, columns))
+                connection.execute("create index %s on %s"%(name, columns))
+        except sqlite3.OperationalError as e:
+            # Read only input or no such table (older rpd files have no rocpd_hsaApi)
+            print("Unable to create index %s: %s"%(name, e))
+    connection.commit()
+
+# Rows are fetched in batches and written through a large buffer, the templates and
+# the bound write are kept in locals of the section functions
+BATCH_ROWS = 10000
+BUFFER_SIZE = 1 << 22
+
+def fetchBatches(query):
+    cursor = connection.execute(query)
+    rows = cursor.fetchmany(BATCH_ROWS)
+    while rows:
+        yield rows
+        rows = cursor.fetchmany(BATCH_ROWS)
+
+needsEscape = re.compile(r'["\\\x00-\x1f]').search
+
+def escape(text):
+    # text as the content of a json string, most strings need nothing
+    if needsEscape(text) is None:
+        return text
+    return json.dumps(text, ensure_ascii=False)[1:-1]
+
+class EscapedNames(dict):
+    # api, op and kernel names repeat a lot, each is escaped once
+    def __missing__(self, name):
+        self[name] = escape(name)
+        return self[name]
+
+names = EscapedNames()
+
+def escapeArgs(rows, column):
+    # The quotes are removed from the args like they always were, so only backslashes
+    # and control characters can need escaping. One check per batch, rows are copied
+    # with escaped args only for the batches that need it
+    args = "".join([row[column] for row in rows])
+    if "\\" not in args and args.isprintable():
+        return rows
+    return [row[:column] + (escape(row[column].replace('"','')),) + row[column + 1:] for row in rows]
+
+def openOutput(file_name, mode='w'):
+    # Fastest gzip level, the json still shrinks ~10x. Appending to a .gz adds a gzip
+    # member, a gzip file can be a concatenation of members
+    if file_name.endswith(".gz"):
+        return io.TextIOWrapper(io.BufferedWriter(gzip.open(file_name, mode + 'b', compresslevel=1), BUFFER_SIZE), encoding="utf-8")
+    return open(file_name, mode, encoding="utf-8", buffering=BUFFER_SIZE)
+
+#Output the process and thread names
+def writeMetadata(out):
+    write = out.write
+    for row in connection.execute("select distinct gpuId from rocpd_op not indexed"):
+        try:
+            write(",{\"name\": \"process_name\", \"ph\": \"M\", \"pid\":\"%s\",\"args\":{\"name\":\"%s\"}}\n"%(row[0], "GPU"+str(row[0])))
+            write(",{\"name\": \"process_sort_index\", \"ph\": \"M\", \"pid\":\"%s\",\"args\":{\"sort_index\":\"%s\"}}\n"%(row[0], row[0] + 1000000))
+        except ValueError:
+            pass
 
-outfile = open(args.output_json, 'w', encoding="utf-8")
-
-if args.format == "object":
-    outfile.write("{\"traceEvents\": ")
-
-outfile.write("[ {}\n");
-
-for row in connection.execute("select distinct gpuId from rocpd_op"):
-    try:
-        outfile.write(",{\"name\": \"process_name\", \"ph\": \"M\", \"pid\":\"%s\",\"args\":{\"name\":\"%s\"}}\n"%(row[0], "GPU"+str(row[0])))
-        outfile.write(",{\"name\": \"process_sort_index\", \"ph\": \"M\", \"pid\":\"%s\",\"args\":{\"sort_index\":\"%s\"}}\n"%(row[0], row[0] + 1000000))
-    except ValueError:
-        outfile.write("")
-
-for row in connection.execute("select distinct pid, tid from rocpd_api"):
-    try:
-        outfile.write(',{"name":"thread_name","ph":"M","pid":"%s","tid":"%s","args":{"name":"%s"}}\n'%(row[0], row[1], "Hip " + str(row[1])))
-        outfile.write(',{"name":"thread_sort_index","ph":"M","pid":"%s","tid":"%s","args":{"sort_index":"%s"}}\n'%(row[0], row[1], row[1] * 2))
-    except ValueError:
-        outfile.write("")
-
-try:
-    # FIXME - these aren't rendering correctly in chrome://tracing
-    for row in connection.execute("select distinct pid, tid from rocpd_hsaApi"):
+    for row in connection.execute("select distinct pid, tid from rocpd_api not indexed"):
         try:
-            outfile.write(',{"name":"thread_name","ph":"M","pid":"%s","tid":"%s","args":{"name":"%s"}}\n'%(row[0], row[1], "HSA " + str(row[1])))
-            outfile.write(',{"name":"thread_sort_index","ph":"M","pid":"%s","tid":"%s","args":{"sort_index":"%s"}}\n'%(row[0], row[1], row[1] * 2 - 1))
+            write(',{"name":"thread_name","ph":"M","pid":"%s","tid":"%s","args":{"name":"%s"}}\n'%(row[0], row[1], "Hip " + str(row[1])))
+            write(',{"name":"thread_sort_index","ph":"M","pid":"%s","tid":"%s","args":{"sort_index":"%s"}}\n'%(row[0], row[1], row[1] * 2))
         except ValueError:
-            outfile.write("")
-except:
-    pass
-
-rangeStringApi = ""
-rangeStringOp = ""
-if args.start:
-    rangeStringApi = "where rocpd_api.start/1000 >= %s"%(args.start)
-    rangeStringOp = "where rocpd_op.start/1000 >= %s"%(args.start)
-if args.end:
-    rangeStringApi = rangeStringApi + " and rocpd_api.start/1000 <= %s"%(args.end) if args.start != None else "where rocpd_api.start/1000 <= %s"%(args.end)
-    rangeStringOp = rangeStringOp + " and rocpd_op.start/1000 <= %s"%(args.end) if args.start != None else "where rocpd_op.start/1000 <= %s"%(args.end)
+            pass
+
+    try:
+        # FIXME - these aren't rendering correctly in chrome://tracing
+        for row in connection.execute("select distinct pid, tid from rocpd_hsaApi not indexed"):
+            try:
+                write(',{"name":"thread_name","ph":"M","pid":"%s","tid":"%s","args":{"name":"%s"}}\n'%(row[0], row[1], "HSA " + str(row[1])))
+                write(',{"name":"thread_sort_index","ph":"M","pid":"%s","tid":"%s","args":{"sort_index":"%s"}}\n'%(row[0], row[1], row[1] * 2 - 1))
+            except ValueError:
+                pass
+    except:
+        pass
+
+# Predicates on the raw ns columns so the start indexes can be used, "start/1000 <= end"
+# is the same as "start < (end + 1) * 1000"
+def rangeConditions(table):
+    conditions = []
+    if args.start:
+        conditions.append("%s.start >= %s"%(table, args.start * 1000))
+    if args.end:
+        conditions.append("%s.start < %s"%(table, (args.end + 1) * 1000))
+    return " and ".join(conditions)
+
+def rangeString(table):
+    conditions = rangeConditions(table)
+    return "where " + conditions if conditions else ""
+
+rangeStringApi = rangeString("rocpd_api")
+rangeStringOp = rangeString("rocpd_op")
+rangeStringHsa = rangeString("rocpd_hsaApi")
+rangeStringFrames = " AND " + rangeConditions("rocpd_api") if rangeStringApi else ""
 
 print("Filter: %s"%(rangeStringApi))
 
@@ -81,45 +193,50 @@ for row in connection.execute("select A.string as optype, B.string as descriptio
         outfile.write("")
 '''
 
-for row in connection.execute("select A.string as optype, B.string as description, gpuId, queueId, rocpd_op.start/1000, (rocpd_op.end-rocpd_op.start) / 1000 from rocpd_op INNER JOIN rocpd_string A on A.id = rocpd_op.opType_id INNER Join rocpd_string B on B.id = rocpd_op.description_id %s"%(rangeStringOp)):
-    try:
-        name =  row[0] if len(row[1])==0 else row[1]
-        cat = "Kernel" if row[0] in ("KernelExecution", "CopyDeviceToDevice") else row[0]
-        outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\", \"cat\":\"%s\", \"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], name, row[4], row[5], cat, row[0]))
-    except ValueError:
-        outfile.write("")
+# "correlation" is the id of the api that launched the op, same as on the api events
+def writeOps(out):
+    write = out.write
+    template = ",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\", \"cat\":\"%s\", \"args\":{\"desc\":\"%s\",\"correlation\":%s}}\n"
+    kernelTypes = ("KernelExecution", "CopyDeviceToDevice")
+    for rows in fetchBatches("select A.string as optype, B.string as description, gpuId, queueId, rocpd_op.start/1000, (rocpd_op.end-rocpd_op.start) / 1000, rocpd_api_ops.api_id from rocpd_op INNER JOIN rocpd_string A on A.id = rocpd_op.opType_id INNER Join rocpd_string B on B.id = rocpd_op.description_id LEFT JOIN rocpd_api_ops on rocpd_api_ops.op_id = rocpd_op.id %s order by rocpd_op.id"%(rangeStringOp)):
+        for row in rows:
+            write(template%(row[2], row[3], names[row[1] or row[0]], row[4], row[5], "Kernel" if row[0] in kernelTypes else names[row[0]], names[row[0]], "null" if row[6] is None else row[6]))
 
 #Output apis
-for row in connection.execute("select A.string as apiName, B.string as args, pid, tid, rocpd_api.start/1000, (rocpd_api.end-rocpd_api.start) / 1000, (rocpd_api.end != rocpd_api.start) as has_duration from rocpd_api INNER JOIN rocpd_string A on A.id = rocpd_api.apiName_id INNER Join rocpd_string B on B.id = rocpd_api.args_id %s order by rocpd_api.id"%(rangeStringApi)):
-    try:
-        if row[0]=="UserMarker":
-            if row[6] == 0:	# instantanuous "mark" messages
-                outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"ph\":\"i\",\"s\":\"p\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], row[1].replace('"',''), row[4], row[1].replace('"','')))
+def writeApis(out):
+    write = out.write
+    markTemplate = ",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"ph\":\"i\",\"s\":\"p\",\"args\":{\"desc\":\"%s\"}}\n"
+    markerTemplate = ",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"
+    apiTemplate = ",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\",\"correlation\":%s}}\n"
+    for rows in fetchBatches("select A.string as apiName, B.string as args, pid, tid, rocpd_api.start/1000, (rocpd_api.end-rocpd_api.start) / 1000, (rocpd_api.end != rocpd_api.start) as has_duration, rocpd_api.id from rocpd_api INNER JOIN rocpd_string A on A.id = rocpd_api.apiName_id INNER Join rocpd_string B on B.id = rocpd_api.args_id %s order by rocpd_api.id"%(rangeStringApi)):
+        for row in escapeArgs(rows, 1):
+            if row[0]=="UserMarker":
+                desc = row[1].replace('"','')
+                if row[6] == 0:	# instantanuous "mark" messages
+                    write(markTemplate%(row[2], row[3], desc, row[4], desc))
+                else:
+                    write(markerTemplate%(row[2], row[3], desc, row[4], row[5], desc))
             else:
-                outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], row[1].replace('"',''), row[4], row[5], row[1].replace('"','')))
-        else:
-          outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], row[0], row[4], row[5], row[1].replace('"','')))
-    except ValueError:
-        outfile.write("")
+                write(apiTemplate%(row[2], row[3], names[row[0]], row[4], row[5], row[1].replace('"',''), row[7]))
 
 #Output api->op linkage
-for row in connection.execute("select rocpd_api_ops.id, pid, tid, gpuId, queueId, rocpd_api.end/1000 - 2, rocpd_op.start/1000, rocpd_api.start/1000 from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id %s"%(rangeStringApi)):
+def writeLinks(out):
+    write = out.write
+    template = ",{\"pid\":\"%s\",\"tid\":\"%s\",\"cat\":\"api_op\",\"name\":\"api_op\",\"ts\":\"%s\",\"id\":\"%s\",\"ph\":\"s\"}\n,{\"pid\":\"%s\",\"tid\":\"%s\",\"cat\":\"api_op\",\"name\":\"api_op\",\"ts\":\"%s\",\"id\":\"%s\",\"ph\":\"f\", \"bp\":\"e\"}\n"
+    for rows in fetchBatches("select rocpd_api_ops.id, pid, tid, gpuId, queueId, rocpd_op.start/1000, rocpd_api.start/1000 from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id %s order by rocpd_api_ops.id"%(rangeStringApi)):
+        for row in rows:
+            write(template%(row[1], row[2], row[6], row[0], row[3], row[4], row[5], row[0]))
+
+def writeHsaApis(out):
+    write = out.write
+    template = ",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"
     try:
-        fromtime = row[5] if row[5] < row[6] else row[6]
-        fromtime = row[7]
-        outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"cat\":\"api_op\",\"name\":\"api_op\",\"ts\":\"%s\",\"id\":\"%s\",\"ph\":\"s\"}\n"%(row[1], row[2], fromtime, row[0]))
-        outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"cat\":\"api_op\",\"name\":\"api_op\",\"ts\":\"%s\",\"id\":\"%s\",\"ph\":\"f\", \"bp\":\"e\"}\n"%(row[3], row[4], row[6], row[0]))
-    except ValueError:
-        outfile.write("")
+        for rows in fetchBatches("select A.string as apiName, B.string as args, pid, tid, rocpd_hsaApi.start/1000, (rocpd_hsaApi.end-rocpd_hsaApi.start) / 1000 from rocpd_hsaApi INNER JOIN rocpd_string A on A.id = rocpd_hsaApi.apiName_id INNER Join rocpd_string B on B.id = rocpd_hsaApi.args_id %s order by rocpd_hsaApi.id"%(rangeStringHsa)):
+            for row in escapeArgs(rows, 1):
+                write(template%(row[2], row[3]+1, names[row[0]], row[4], row[5], row[1].replace('"','')))
+    except sqlite3.OperationalError:
+        pass    # Older rpd files have no HSA api table
 
-try:
-    for row in connection.execute("select A.string as apiName, B.string as args, pid, tid, rocpd_hsaApi.start/1000, (rocpd_hsaApi.end-rocpd_hsaApi.start) / 1000 from rocpd_hsaApi INNER JOIN rocpd_string A on A.id = rocpd_hsaApi.apiName_id INNER Join rocpd_string B on B.id = rocpd_hsaApi.args_id %s order by rocpd_hsaApi.id"%(rangeStringApi)):
-        try:
-            outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3]+1, row[0], row[4], row[5], row[1].replace('"','')))
-        except ValueError:
-            outfile.write("")
-except:
-    pass
 
 
 #
@@ -135,139 +252,202 @@ for row in connection.execute("SELECT max(end)/1000 from (SELECT end from rocpd_
 
 # Loop over GPU for per-gpu counters
 gpuIdsPresent = []
-for row in connection.execute("SELECT DISTINCT gpuId FROM rocpd_op"):
+for row in connection.execute("SELECT DISTINCT gpuId FROM rocpd_op NOT INDEXED"):
     gpuIdsPresent.append(row[0])
 
 for gpuId in gpuIdsPresent:
     print(f"Creating counters for: {gpuId}")
 
-    #Create the queue depth counter
-    depth = 0
-    idle = 1
-    for row in connection.execute("select * from (select rocpd_api.start/1000 as ts, \"1\" from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id AND rocpd_op.gpuId = %s %s UNION ALL select rocpd_op.end/1000, \"-1\" from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id AND rocpd_op.gpuId = %s %s) order by ts"%(gpuId, rangeStringOp, gpuId, rangeStringOp)):
-        try:
-           if idle and int(row[1]) > 0:
-               idle = 0
-               outfile.write(',{"pid":"%s","name":"Idle","ph":"C","ts":%s,"args":{"idle":%s}}\n'%(gpuId, row[0], idle))
-           if depth == 1 and int(row[1]) < 0:
-               idle = 1
-               outfile.write(',{"pid":"%s","name":"Idle","ph":"C","ts":%s,"args":{"idle":%s}}\n'%(gpuId, row[0], idle))
-           depth = depth + int(row[1])
-           outfile.write(',{"pid":"%s","name":"QueueDepth","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(gpuId, row[0], depth))
-        except ValueError:
-            outfile.write("")
-    if T_end > 0:
-            outfile.write(',{"pid":"%s","name":"Idle","ph":"C","ts":%s,"args":{"idle":%s}}\n'%(gpuId, T_end, idle))
-            outfile.write(',{"pid":"%s","name":"QueueDepth","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(gpuId, T_end, depth))
+#Create the queue depth counters
+# One query for all the GPUs, ordered by the position of the GPU in gpuIdsPresent and
+# then by ts, so the counters of each GPU still come out together and in the same
+# order. Each GPU has its own depth/idle state
+def writeQueueCounters(out):
+    write = out.write
+    idleTemplate = ',{"pid":"%s","name":"Idle","ph":"C","ts":%s,"args":{"idle":%s}}\n'
+    depthTemplate = ',{"pid":"%s","name":"QueueDepth","ph":"C","ts":%s,"args":{"depth":%s}}\n'
+    depth = dict.fromkeys(gpuIdsPresent, 0)
+    idle = dict.fromkeys(gpuIdsPresent, 1)
+
+    def endCounters(gpuId):
+        if T_end > 0:
+            write(idleTemplate%(gpuId, T_end, idle[gpuId]))
+            write(depthTemplate%(gpuId, T_end, depth[gpuId]))
+
+    gpuOrder = " ".join("when %s then %s"%(gpuId, i) for i, gpuId in enumerate(gpuIdsPresent))
+    done = 0    # number of GPUs of gpuIdsPresent with complete counters
+    if gpuIdsPresent:
+        for rows in fetchBatches("select * from (select rocpd_op.gpuId as gpu, rocpd_api.start/1000 as ts, 1 from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id %s UNION ALL select rocpd_op.gpuId, rocpd_op.end/1000, -1 from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id %s) order by case gpu %s end, ts"%(rangeStringOp, rangeStringOp, gpuOrder)):
+            for gpuId, ts, delta in rows:
+                while gpuIdsPresent[done] != gpuId:    # first row of the next GPU
+                    endCounters(gpuIdsPresent[done])
+                    done = done + 1
+                if idle[gpuId] and delta > 0:
+                    idle[gpuId] = 0
+                    write(idleTemplate%(gpuId, ts, 0))
+                if depth[gpuId] == 1 and delta < 0:
+                    idle[gpuId] = 1
+                    write(idleTemplate%(gpuId, ts, 1))
+                depth[gpuId] = depth[gpuId] + delta
+                write(depthTemplate%(gpuId, ts, depth[gpuId]))
+    for gpuId in gpuIdsPresent[done:]:
+        endCounters(gpuId)
 
 #Create the (global) memory counter
-sizes = {}    # address -> size
-totalSize = 0
-exp = re.compile("^ptr\((.*)\)\s+size\((.*)\)$")
-exp2 = re.compile("^ptr\((.*)\)$")
-for row in connection.execute("SELECT rocpd_api.end/1000 as ts, B.string, '1'  FROM rocpd_api INNER JOIN rocpd_string A ON A.id=rocpd_api.apiName_id INNER JOIN rocpd_string B ON B.id=rocpd_api.args_id WHERE A.string='hipFree' UNION ALL SELECT rocpd_api.start/1000, B.string, '0' FROM rocpd_api INNER JOIN rocpd_string A ON A.id=rocpd_api.apiName_id INNER JOIN rocpd_string B ON B.id=rocpd_api.args_id WHERE A.string='hipMalloc' ORDER BY ts asc"):
-    try:
-        if row[2] == '0':  #malloc
-            m = exp.match(row[1])
-            if m:
-                size = int(m.group(2), 16)
+# ptr and size are cut out of the args by SQL (ptr(...) size(...) with one space), only
+# the hex sizes are parsed in python. The last size of each pointer is kept so a free
+# removes what was allocated last, a second free removes nothing and frees of unknown
+# pointers are skipped
+def writeMemoryCounter(out):
+    write = out.write
+    template = ',{"pid":"0","name":"Allocated Memory","ph":"C","ts":%s,"args":{"depth":%s}}\n'
+    resolution = args.memory_resolution
+    sizes = {}    # address -> size
+    totalSize = 0
+    bucket = None    # with a resolution: (index, ts, peak) of the current interval
+    for rows in fetchBatches("SELECT rocpd_api.end/1000 as ts, substr(B.string, 5, length(B.string) - 5), NULL FROM rocpd_api INNER JOIN rocpd_string B ON B.id=rocpd_api.args_id WHERE rocpd_api.apiName_id IN (SELECT id FROM rocpd_string WHERE string='hipFree') AND B.string GLOB 'ptr(*)' UNION ALL SELECT rocpd_api.start/1000, substr(B.string, 5, instr(B.string, ') size(') - 5), substr(B.string, instr(B.string, ') size(') + 7, length(B.string) - instr(B.string, ') size(') - 7) FROM rocpd_api INNER JOIN rocpd_string B ON B.id=rocpd_api.args_id WHERE rocpd_api.apiName_id IN (SELECT id FROM rocpd_string WHERE string='hipMalloc') AND B.string GLOB 'ptr(*) size(*)' ORDER BY ts asc"):
+        for ts, ptr, size in rows:
+            if size is not None:  #malloc
+                try:
+                    size = int(size, 16)
+                except ValueError:
+                    continue
                 totalSize = totalSize + size
-                sizes[m.group(1)] = size
-                outfile.write(',{"pid":"0","name":"Allocated Memory","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(row[0],totalSize))
-        else:              #free
-            m = exp2.match(row[1])
-            if m:
-                try:    # Sometimes free addresses are not valid or listed
-                    size = sizes[m.group(1)]
-                    sizes[m.group(1)] = 0
-                    totalSize = totalSize - size;
-                    outfile.write(',{"pid":"0","name":"Allocated Memory","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(row[0],totalSize))
-                except KeyError:
-                    pass
-    except ValueError:
-        outfile.write("")
-if T_end > 0:
-    outfile.write(',{"pid":"0","name":"Allocated Memory","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(T_end,totalSize))
+                sizes[ptr] = size
+            elif ptr in sizes:  #free, sometimes free addresses are not valid or listed
+                totalSize = totalSize - sizes[ptr]
+                sizes[ptr] = 0
+            else:
+                continue
+            if not resolution:
+                write(template%(ts, totalSize))
+            elif bucket is not None and bucket[0] == ts // resolution:
+                if totalSize > bucket[2]:
+                    bucket[2] = totalSize
+            else:
+                # One sample per interval: the peak of the interval at its first event
+                if bucket is not None:
+                    write(template%(bucket[1], bucket[2]))
+                bucket = [ts // resolution, ts, totalSize]
+    if bucket is not None:
+        write(template%(bucket[1], bucket[2]))
+    if T_end > 0:
+        write(template%(T_end, totalSize))
 
 #Create "faux calling stack frame" on gpu ops traceS
-stacks = {}          # Call stacks built from UserMarker entres.     Key is 'pid,tid'
-currentFrame = {}    #"Current GPU frame" (id, name, start, end).    Key is 'pid,tid'
-
 class GpuFrame:
-    def __init__(self):
-        self.id = 0
-        self.name = ''
-        self.start = 0
-        self.end = 0
-        self.gpus = []
-        self.totalOps = 0
-
-# FIXME: include 'start' (in ns) so we can ORDER BY it and break ties?
-for row in connection.execute("SELECT '0', start/1000, pid, tid, B.string as label, '','','', '' from rocpd_api INNER JOIN rocpd_string A on A.id = rocpd_api.apiName_id AND A.string = 'UserMarker' INNER JOIN rocpd_string B on B.id = rocpd_api.args_id AND rocpd_api.start/1000 != rocpd_api.end/1000 UNION ALL SELECT '1', end/1000, pid, tid, B.string as label, '','','', '' from rocpd_api INNER JOIN rocpd_string A on A.id = rocpd_api.apiName_id AND A.string = 'UserMarker' INNER JOIN rocpd_string B on B.id = rocpd_api.args_id AND rocpd_api.start/1000 != rocpd_api.end/1000 UNION ALL SELECT '2', rocpd_api.start/1000, pid, tid, '' as label, gpuId, queueId, rocpd_op.start/1000, rocpd_op.end/1000 from rocpd_api_ops INNER JOIN rocpd_api ON rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op ON rocpd_api_ops.op_id = rocpd_op.id ORDER BY start/1000 asc"):
+    __slots__ = ("id", "name", "start", "end", "gpus", "totalOps")
+
+    def __init__(self, frame, start, end, gpu):
+        self.id = frame[0]
+        self.name = frame[1]
+        self.start = start
+        self.end = end
+        self.gpus = [gpu]
+        self.totalOps = 1
+
+# The UserMarker starts, UserMarker ends and api+op launches are three queries each
+# sorted on its raw ns time, merged here with a heap so the whole union is never
+# sorted or held. With the frame indexes the starts and launches are index scans in
+# start order, without them SQLite sorts each query. The ends are always sorted, but
+# that is only the UserMarker rows. Events are (ns, kind, us,
+# pid, tid, ...), on equal ns ends come before starts before launches: a UserMarker
+# ending where the next one starts on the same thread is closed first (a kept marker
+# never starts and ends on the same ns). Only the open UserMarkers and the current
+# frame of each (pid, tid) are kept
+def writeFrames(out):
+    write = out.write
+    template = ',{"pid":"%s","tid":"%s","name":"%s","ts":"%s","dur":"%s","ph":"X","args":{"desc":"%s"}}\n'
+    stacks = {}          # Call stacks built from UserMarker entres.     Key is (pid, tid)
+    currentFrame = {}    # "Current GPU frame" GpuFrame.                  Key is (pid, tid)
+    markers = "rocpd_api.apiName_id IN (SELECT id FROM rocpd_string WHERE string = 'UserMarker') AND rocpd_api.start/1000 != rocpd_api.end/1000" + rangeStringFrames
+
+    def events(query, kind):
+        for rows in fetchBatches(query):
+            for row in rows:
+                yield (row[0], kind) + row[1:]
+
+    def writeFrame(gpuFrame):
+        for dest in gpuFrame.gpus:
+            write(template%(dest[0], dest[1], names[gpuFrame.name], gpuFrame.start - 1, gpuFrame.end - gpuFrame.start + 1, f"UserMarker frame: {gpuFrame.totalOps} ops"))
+
+    starts = events("SELECT rocpd_api.start, rocpd_api.start/1000, pid, tid, B.string FROM rocpd_api INNER JOIN rocpd_string B on B.id = rocpd_api.args_id WHERE %s ORDER BY rocpd_api.start"%(markers), 1)
+    ends = events("SELECT rocpd_api.end, rocpd_api.end/1000, pid, tid FROM rocpd_api WHERE %s ORDER BY rocpd_api.end"%(markers), 0)
+    if len(connection.execute("select name from sqlite_master where type = 'index' and name in (?, ?)", frameIndexes).fetchall()) == 2:
+        # Forces rocpd_api first (in index order) with the api_ops looked up by api_id,
+        # SQLite would rather scan rocpd_api_ops and sort the whole join
+        launchJoin = "rocpd_api CROSS JOIN rocpd_api_ops ON rocpd_api_ops.api_id = rocpd_api.id"
+    else:
+        launchJoin = "rocpd_api_ops INNER JOIN rocpd_api ON rocpd_api_ops.api_id = rocpd_api.id"
+    launches = events("SELECT rocpd_api.start, rocpd_api.start/1000, pid, tid, gpuId, queueId, rocpd_op.start/1000, rocpd_op.end/1000 from %s %s INNER JOIN rocpd_op ON rocpd_api_ops.op_id = rocpd_op.id ORDER BY rocpd_api.start"%(launchJoin, rangeStringFrames), 2)
+    for event in heapq.merge(starts, ends, launches):
+        key = (event[3], event[4])
+        if event[1] == 1:  # Frame start
+            stacks.setdefault(key, []).append((event[2], event[5]))
+
+        elif event[1] == 0:  #Frame end
+            stacks[key].pop()
+
+        elif key in stacks and len(stacks[key]) > 0:  # API + Op under a frame
+            frame = stacks[key][-1]
+            opStart, opEnd = event[7], event[8]
+            gpuFrame = currentFrame.get(key)
+            if gpuFrame is None:    # First op under the current api frame
+                currentFrame[key] = GpuFrame(frame, opStart, opEnd, (event[5], event[6]))
+            # Another op under the same frame -> union them (but only if they are butt together)
+            elif gpuFrame.id == frame[0] and gpuFrame.name == frame[1] and (abs(opStart - gpuFrame.end) < 200 or abs(gpuFrame.start - opEnd) < 200):
+                if opStart < gpuFrame.start: gpuFrame.start = opStart
+                if opEnd > gpuFrame.end: gpuFrame.end = opEnd
+                if (event[5], event[6]) not in gpuFrame.gpus: gpuFrame.gpus.append((event[5], event[6]))
+                gpuFrame.totalOps = gpuFrame.totalOps + 1
+            else:    #This is a new frame - dump the last and make new
+                writeFrame(gpuFrame)
+                currentFrame[key] = GpuFrame(frame, opStart, opEnd, (event[5], event[6]))
+
+    # The last frame of each thread
+    for gpuFrame in currentFrame.values():
+        writeFrame(gpuFrame)
+
+# The sections only read the db, each one can be written by its own process with its
+# own read only connection into a temporary shard, the shards are then copied into the
+# output in order. Shards of a .gz output are gzip members themselves so they take
+# about as much space as the output. Needs fork since this script has no main guard
+sections = [writeMetadata, writeOps, writeApis, writeLinks, writeHsaApis, writeQueueCounters, writeMemoryCounter, writeFrames]
+
+def initWorker():
+    global connection
+    connection = sqlite3.connect(pathlib.Path(dbPath).resolve().as_uri() + "?mode=ro", uri=True)
+
+def writeShard(section, shard):
+    with openOutput(shard) as out:
+        section(out)
+    return shard
+
+header = ("{\"traceEvents\": " if args.format == "object" else "") + "[ {}\n"
+footer = "]\n" + ("} \n" if args.format == "object" else "")
+
+if args.workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+    with openOutput(args.output_json) as outfile:
+        outfile.write(header)
+    shardDir = tempfile.mkdtemp(prefix="rpd2tracing_", dir=args.tmp_dir or os.path.dirname(os.path.abspath(args.output_json)))
+    shardSuffix = ".json.gz" if args.output_json.endswith(".gz") else ".json"
     try:
-        key = (row[2], row[3])    # Key is 'pid,tid'
-        if row[0] == '0':  # Frame start
-            if key not in stacks:
-                stacks[key] = []
-            stack = stacks[key].append((row[1], row[4]))
-            #print(f"0: new api frame: pid_tid={key} -> stack={stacks}")
-
-        elif row[0] == '1':  #Frame end
-            completed = stacks[key].pop()
-            #print(f"1: end api frame: pid_tid={key} -> stack={stacks}")
-
-        elif row[0] == '2':  # API + Op
-            if key in stacks and len(stacks[key]) > 0:
-                frame = stacks[key][-1]
-                #print(f"2: Op on {frame} ({len(stacks[key])})")
-                gpuFrame = None
-                if key not in currentFrame:    # First op under the current api frame
-                    gpuFrame = GpuFrame()
-                    gpuFrame.id = frame[0]
-                    gpuFrame.name = frame[1]
-                    gpuFrame.start = row[7]
-                    gpuFrame.end = row[8]
-                    gpuFrame.gpus.append((row[5], row[6]))
-                    gpuFrame.totalOps = 1
-                    #print(f"2a: new frame: {gpuFrame.gpus} {gpuFrame.start} {gpuFrame.end} {gpuFrame.end - gpuFrame.start}")
-                else:
-                    gpuFrame = currentFrame[key]
-                    # Another op under the same frame -> union them (but only if they are butt together)
-                    if gpuFrame.id == frame[0] and gpuFrame.name == frame[1] and (abs(row[7] - gpuFrame.end) < 200 or abs(gpuFrame.start - row[8]) < 200): 
-                    #if gpuFrame.id == frame[0] and gpuFrame.name == frame[1]:    # Another op under the same frame -> union them
-                    #if False:   # Turn off frame joining
-                        if row[7] < gpuFrame.start: gpuFrame.start = row[7]
-                        if row[8] > gpuFrame.end: gpuFrame.end = row[8] 
-                        if (row[5], row[6]) not in gpuFrame.gpus: gpuFrame.gpus.append((row[5], row[6]))
-                        gpuFrame.totalOps = gpuFrame.totalOps + 1
-                        #print(f"2c: union frame: {gpuFrame.gpus} {gpuFrame.start} {gpuFrame.end} {gpuFrame.end - gpuFrame.start}")
-
-                    else:    #This is a new frame - dump the last and make new
-                        gpuFrame = currentFrame[key]
-                        for dest in gpuFrame.gpus:
-                            #print(f"2: OUTPUT: dest={dest} time={gpuFrame.start} -> {gpuFrame.end} Duration={gpuFrame.end - gpuFrame.start} TotalOps={gpuFrame.totalOps}")
-                            outfile.write(',{"pid":"%s","tid":"%s","name":"%s","ts":"%s","dur":"%s","ph":"X","args":{"desc":"%s"}}\n'%(dest[0], dest[1], gpuFrame.name, gpuFrame.start - 1, gpuFrame.end - gpuFrame.start + 1, f"UserMarker frame: {gpuFrame.totalOps} ops"))
-                        currentFrame.pop(key)
-
-                        # make the first op under the new frame
-                        gpuFrame = GpuFrame()
-                        gpuFrame.id = frame[0]
-                        gpuFrame.name = frame[1]
-                        gpuFrame.start = row[7]
-                        gpuFrame.end = row[8]
-                        gpuFrame.gpus.append((row[5], row[6]))
-                        gpuFrame.totalOps = 1
-                        #print(f"2b: new frame: {gpuFrame.gpus} {gpuFrame.start} {gpuFrame.end} {gpuFrame.end - gpuFrame.start}")
-
-                currentFrame[key] = gpuFrame
-
-    except ValueError:
-        outfile.write("")
-
-outfile.write("]\n")
-
-if args.format == "object":
-    outfile.write("} \n")
+        with ProcessPoolExecutor(min(args.workers, len(sections)), mp_context=multiprocessing.get_context("fork"), initializer=initWorker) as pool:
+            shards = [pool.submit(writeShard, section, os.path.join(shardDir, "%d%s"%(i, shardSuffix))) for i, section in enumerate(sections)]
+            with open(args.output_json, 'ab') as raw:
+                for shard in shards:
+                    with open(shard.result(), 'rb') as f:
+                        shutil.copyfileobj(f, raw, BUFFER_SIZE)
+                    os.remove(shard.result())
+    finally:
+        shutil.rmtree(shardDir, ignore_errors=True)
+    with openOutput(args.output_json, 'a') as outfile:
+        outfile.write(footer)
+else:
+    with openOutput(args.output_json) as outfile:
+        outfile.write(header)
+        for section in sections:
+            section(outfile)
+        outfile.write(footer)
 
-outfile.close()
 connection.close()
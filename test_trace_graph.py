@@ -0,0 +1,85 @@
+import random
+import unittest
+
+from trace_graph import Graph, Node
+
+
+def nestedIntervals(rnd, start, end, depth, intervals):
+    """
+    Random properly nested (start, duration) intervals inside [start, end): siblings
+    often touch, some have zero duration and some cover their whole parent.
+    """
+    if depth == 0 or end <= start:
+        return
+    cuts = sorted(rnd.randint(start, end) for _ in range(rnd.randint(1, 6)))
+    bounds = [start] + cuts + [end]
+    for lo, hi in zip(bounds, bounds[1:]):
+        r = rnd.random()
+        if r < 0.2:
+            # Zero duration, often on a sibling boundary
+            intervals.append((rnd.choice((lo, hi)), 0))
+        elif r < 0.85:
+            intervals.append((lo, hi - lo))
+            nestedIntervals(rnd, lo, hi, depth - 1, intervals)
+
+
+def opNode(name, start, duration):
+    return Node(
+        {"name": name, "ts": start, "dur": duration, "cat": "cpu_op", "pid": 1, "tid": 1}
+    )
+
+
+def parentsOf(nodes):
+    index = {id(node): i for i, node in enumerate(nodes)}
+    return [index.get(id(node.parent), -1) for node in nodes]
+
+
+class AddNodesTest(unittest.TestCase):
+    def build(self, intervals, batch):
+        g = Graph()
+        nodes = [
+            opNode(f"op{i}", start, duration)
+            for i, (start, duration) in enumerate(intervals)
+        ]
+        if batch:
+            g.addNodes(nodes)
+        else:
+            for node in nodes:
+                g.addNode(node)
+        return parentsOf(nodes)
+
+    def testZeroDurationOnBoundary(self):
+        intervals = [(0, 10), (10, 0), (10, 10)]
+        self.assertEqual(self.build(intervals, True), [-1, 0, -1])
+        self.assertEqual(self.build(intervals, False), [-1, 0, -1])
+
+    def testZeroDurationAdoptedByLaterStart(self):
+        # Nothing before it contains the zero duration op, the ops starting with it do
+        intervals = [(10, 0), (10, 10), (10, 5)]
+        self.assertEqual(self.build(intervals, True), [2, -1, 1])
+        self.assertEqual(self.build(intervals, False), [2, -1, 1])
+
+    def testRandomNestedSameAsAddNode(self):
+        rnd = random.Random(0)
+        for _ in range(300):
+            intervals = []
+            nestedIntervals(rnd, 0, rnd.randint(1, 60), 4, intervals)
+            # Start ordered, ties in random order
+            rnd.shuffle(intervals)
+            intervals.sort(key=lambda interval: interval[0])
+            self.assertEqual(
+                self.build(intervals, True), self.build(intervals, False), intervals
+            )
+
+
+class SearchTest(unittest.TestCase):
+    def testUnknownThread(self):
+        g = Graph()
+        g.addNodes([opNode("op", 0, 10)])
+        self.assertEqual(g.search(5, 1, 1).name, "op")
+        self.assertIs(g.search(20, 1, 1), g.top_node)
+        self.assertIsNone(g.search(5, 1, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from trace_analyzer import buildGraph
+from trace_reader import parseTrace
+
+
+def event(ph, cat, name, pid, tid, ts, **fields):
+    return {
+        "ph": ph,
+        "cat": cat,
+        "name": name,
+        "pid": pid,
+        "tid": tid,
+        "ts": ts,
+        **fields,
+    }
+
+
+def writeTrace(path, steps=6, seed=0, op_name="aten::mm"):
+    """
+    PyTorch like trace: ProfilerStep# markers, nested cpu ops, launches with their
+    kernels (with and without correlation ids) and flow events. The GPU side copies
+    of the markers come at the end of the file, a bit later than the cpu ones.
+    """
+    rnd = random.Random(seed)
+    events = []
+    gpu_markers = []
+    t = 1000
+    correlation = 0
+    for step in range(steps):
+        name = f"ProfilerStep#{step}"
+        events.append(event("X", "user_annotation", name, 1, 1, t, dur=0, args={}))
+        gpu_markers.append(
+            event("X", "gpu_user_annotation", name, 0, 7, t + 7, dur=0, args={})
+        )
+        for _ in range(rnd.randint(3, 8)):
+            start = t
+            t += 2
+            correlation += 1
+            args = {"correlation": correlation} if rnd.random() < 0.7 else {}
+            kernel_ts = t + rnd.randint(1, 30)
+            events.append(
+                event("X", "cuda_runtime", "cudaLaunchKernel", 1, 1, t, dur=2, args=args)
+            )
+            events.append(event("X", "kernel", "gemm", 0, 7, kernel_ts, dur=5, args=args))
+            events.append(event("s", "ac2g", "ac2g", 1, 1, t, id=correlation))
+            events.append(event("f", "ac2g", "ac2g", 0, 7, kernel_ts, id=correlation))
+            t += 4
+            events.append(
+                event("X", "cpu_op", op_name, 1, 1, start, dur=t - start, args={})
+            )
+            t += 1
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events + gpu_markers}, f, ensure_ascii=False)
+
+
+def treeOf(g):
+    return [
+        (node.name, node.start, node.parent.name if node.parent else None)
+        for node in g.toList()
+    ]
+
+
+class ParseTraceTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        writeTrace(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testWindowSameAsWholeTrace(self):
+        # Late markers move every window, so this also covers the second pass
+        whole = parseTrace(self.path)
+        for iteration in range(6):
+            for num_iterations in (1, 2):
+                trace = parseTrace(self.path, None, iteration, num_iterations)
+                if iteration + num_iterations < 6:
+                    self.assertLess(len(trace.ops), len(whole.ops))
+                self.assertEqual(
+                    treeOf(buildGraph(trace, iteration, num_iterations)),
+                    treeOf(buildGraph(whole, iteration, num_iterations)),
+                    (iteration, num_iterations),
+                )
+
+
+class ParseTraceChunkedTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        # Looks like an event boundary inside a string
+        writeTrace(self.path, op_name='aten::mm, {"name": "é"}')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testSameAsSerial(self):
+        for window in ((), (2,), (1, 3)):
+            serial = parseTrace(self.path, None, *window).toColumns()
+            for workers in (2, 3, 8, 64):
+                self.assertEqual(
+                    parseTrace(self.path, workers, *window).toColumns(),
+                    serial,
+                    (window, workers),
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
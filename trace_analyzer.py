@@ -1,152 +1,357 @@
-import json
-import sys
+import os
 from trace_graph import Graph, Node
-from trace_utils import calcAllBW, shortName, getMedian
-from collections.abc import Iterable
+from trace_utils import (
+    calcAllBW,
+    shortName,
+    OpSummary,
+    SUMMARY_COLUMNS,
+    summarizeDurations,
+)
+from trace_reader import parseTrace
+from trace_rpd import parseRpd
+from trace_table import HAVE_NUMPY
+from trace_sketch import QuantileSketch, RELATIVE_ACCURACY
+from trace_cache import (
+    GraphCache,
+    DEFAULT_CACHE_DIR,
+    DEFAULT_MAX_SIZE,
+    graphFromArrays,
+    graphToArrays,
+)
+from trace_export import FORMATS, writeCSV, writeNPZ
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
+from types import MappingProxyType
 import xlsxwriter
 import argparse
+import heapq
 
 
-def getIterationTimes(data, iteration, num_iterations=1):
-    starting_time = 0
-    ending_time = float("inf")
-    iteration_start = str(iteration)
-    iteration_stop = str(iteration + num_iterations)
-    for i in range(0, len(data["traceEvents"])):
-        try:
-            if ("iteration" + iteration_start) in data["traceEvents"][i]["name"]:
-                starting_time = int(data["traceEvents"][i]["ts"])
-            if ("iteration" + iteration_stop) in data["traceEvents"][i]["name"]:
-                ending_time = int(data["traceEvents"][i]["ts"])
-            if ("ProfilerStep#" + iteration_start) in data["traceEvents"][i]["name"]:
-                starting_time = int(data["traceEvents"][i]["ts"])
-            if ("ProfilerStep#" + iteration_stop) in data["traceEvents"][i]["name"]:
-                ending_time = int(data["traceEvents"][i]["ts"])
-        except KeyError:
-            pass
-    return starting_time, ending_time
-
-
-def processJson(file_name, iteration=None):
-    f = open(file_name)
-    data = json.load(f)
+def processJson(file_name, iteration=None, num_iterations=1, workers=None, cache=None):
+    if cache is not None:
+        g = cache.load(file_name, iteration, num_iterations)
+        if g is not None:
+            return g
+    return parseGraph(file_name, iteration, num_iterations, workers, cache)
+
+
+def parseGraph(file_name, iteration=None, num_iterations=1, workers=None, cache=None):
+    if file_name.endswith(".rpd"):
+        trace = parseRpd(file_name, iteration, num_iterations)
+    else:
+        trace = parseTrace(file_name, workers, iteration, num_iterations)
+    g = buildGraph(trace, iteration, num_iterations, workers)
+    if cache is not None:
+        cache.save(g, file_name, iteration, num_iterations)
+    return g
+
+
+def _parseGraphArrays(*args):
+    # Runs in a loader process, the graph is sent back as arrays instead of pickled Nodes
+    return graphToArrays(parseGraph(*args))
+
+
+def loadTraces(traces, num_iterations=1, workers=None, cache=None, load_workers=None):
+    """
+    Graphs of a list of (file name, iteration) pairs. Cached graphs are loaded
+    directly, the others are parsed once per distinct trace window (repeats get a
+    copy), with load_workers > 1 (by default the number of CPUs) and NumPy in
+    parallel processes.
+    """
+    if load_workers is None:
+        load_workers = os.cpu_count() or 1
+    graphs = [None] * len(traces)
+    to_parse = {}
+    for i, (file_name, iteration) in enumerate(traces):
+        if cache is not None:
+            graphs[i] = cache.load(file_name, iteration, num_iterations)
+        if graphs[i] is None:
+            to_parse.setdefault((file_name, iteration), []).append(i)
+
+    if HAVE_NUMPY and load_workers > 1 and len(to_parse) > 1:
+        with ProcessPoolExecutor(max_workers=min(load_workers, len(to_parse))) as pool:
+            futures = {
+                trace: pool.submit(
+                    _parseGraphArrays, *trace, num_iterations, workers, cache
+                )
+                for trace in to_parse
+            }
+            for trace, future in futures.items():
+                arrays = future.result()
+                for i in to_parse[trace]:
+                    graphs[i] = graphFromArrays(*arrays)
+    else:
+        for trace, indices in to_parse.items():
+            g = parseGraph(*trace, num_iterations, workers, cache)
+            graphs[indices[0]] = g
+            # The graphs are changed by the report (kernel rollup), each gets its own
+            for i in indices[1:]:
+                graphs[i] = g.copy()
+    return graphs
+
+
+def buildGraph(trace, iteration=None, num_iterations=1, workers=None):
     g = Graph()
     starting_time = 0
     ending_time = float("inf")
+    nodes = []
+    # correlation id -> earliest op carrying it, the api call comes before its GPU ops
+    launchers = {}
+    # (pid, tid, ts) -> kernel, for traces without correlation ids
     kernels = {}
+    needs_flows = False
+    # correlation ids of kernels in the window that have no launcher in the window
+    missing = []
     op_links = {}
 
     if iteration is not None:
-        starting_time, ending_time = getIterationTimes(data, iteration)
-
-    for i in range(0, len(data["traceEvents"])):
-        # TODO: put the time check on its own if
-        if (
-            (data["traceEvents"][i].keys() >= {"name", "ts", "dur", "args"})
-            and (int(data["traceEvents"][i]["ts"]) >= starting_time)
-            and (int(data["traceEvents"][i]["ts"]) <= ending_time)
-        ):
-            n = Node(data["traceEvents"][i])
-            if n.is_kernel:
-                kernels[n.start] = n
-            else:
-                # The "hints" from amd side would count twice
-                if "UserMarker" not in data["traceEvents"][i]["args"].setdefault(
-                    "desc", ""
-                ):
-                    g.addNode(n)
-        # XXX: Sometime kernels are launched after the iteration, choosing an arbritary buffer.
-        elif (
-            (data["traceEvents"][i].keys() >= {"name", "ts", "dur", "args", "cat"})
-            and (int(data["traceEvents"][i]["ts"]) >= starting_time)
-            # and (int(data["traceEvents"][i]["ts"]) <= ending_time + 100000000000)
-            and (
-                data["traceEvents"][i]["cat"]
-                in (
-                    "Kernel",
-                    "KernelExecution",
-                    "FillBuffer",
-                    "Memset",
-                    "kernel",
-                    "Memcpy",
-                    "gpu_memcpy",
-                    "gpu_memset",
-                )
+        starting_time, ending_time = trace.getIterationTimes(iteration, num_iterations)
+
+    for event in trace.ops:
+        if event.ts >= starting_time and event.ts <= ending_time:
+            n = Node.fromFields(
+                event.name,
+                event.ts,
+                event.dur,
+                event.cat,
+                event.pid,
+                event.tid,
+                event.args,
             )
-        ):
-            n = Node(data["traceEvents"][i])
-            kernels[n.start] = n
-        elif (
-            (data["traceEvents"][i].keys() >= {"name", "ts", "cat", "ph"})
-            and (data["traceEvents"][i]["ph"] in ("f", "s"))
-            and (int(data["traceEvents"][i]["ts"]) >= starting_time)
-            # and (int(data["traceEvents"][i]["ts"]) <= ending_time)
-            # or (data["traceEvents"][i]["id"] in op_links.keys())
-        ):
-            op_links.setdefault(data["traceEvents"][i]["id"], []).append(
-                data["traceEvents"][i]
+            nodes.append(n)
+            correlation = event.correlation
+            if correlation is not None and (
+                correlation not in launchers or n.start < launchers[correlation].start
+            ):
+                launchers[correlation] = n
+    g.addNodes(nodes, workers)
+
+    # XXX: Sometime kernels are launched after the iteration, no upper bound on them.
+    for event in trace.kernels:
+        if event.ts >= starting_time:
+            n = Node.fromFields(
+                event.name,
+                event.ts,
+                event.dur,
+                event.cat,
+                event.pid,
+                event.tid,
+                event.args,
             )
+            correlation = event.correlation
+            if correlation is None:
+                kernels[(n.pid, n.tid, n.start)] = n
+                needs_flows = True
+            elif correlation in launchers:
+                # XXX: breaking time guarantee of graph
+                launchers[correlation].children.append(n)
+                n.parent = launchers[correlation]
+            elif n.start <= ending_time:
+                missing.append(correlation)
+
+    # Fallback, join flow events on timestamps
+    unmatched_flows = 0
+    unmatched_kernels = 0
+    if needs_flows:
+        for event in trace.flows:
+            if event.ts >= starting_time:
+                op_links.setdefault(event.id, []).append(event)
 
     for key in op_links.keys():
         if len(op_links[key]) != 2:
             continue
-        # TODO: Once we fix AMD do this on correlation IDs not timestamps
         op_link_start = (
-            op_links[key][0] if op_links[key][0]["ph"] == "s" else op_links[key][1]
+            op_links[key][0] if op_links[key][0].ph == "s" else op_links[key][1]
         )
-        if int(op_link_start["ts"]) > ending_time:
+        if op_link_start.ts > ending_time:
             continue
         op_link_finish = (
-            op_links[key][0] if op_links[key][0]["ph"] == "f" else op_links[key][1]
+            op_links[key][0] if op_links[key][0].ph == "f" else op_links[key][1]
         )
-        try:
-            kernel = kernels[int(op_link_finish["ts"])]
-            launcher = g.search(int(op_link_start["ts"]))
-        except Exception as e:
-            print(f"Unable to find kernel exected at: {int(op_link_finish['ts'])}")
-            raise
+        kernel = kernels.get((op_link_finish.pid, op_link_finish.tid, op_link_finish.ts))
+        if kernel is None:
+            unmatched_flows += 1
+            continue
+        launcher = g.search(op_link_start.ts, op_link_start.pid, op_link_start.tid)
+        if launcher is None:
+            # No op of the launching thread in the window
+            unmatched_kernels += 1
+            continue
         # XXX: breaking time guarantee of graph
         launcher.children.append(kernel)
         kernel.parent = launcher
 
+    if kernels:
+        # Kernels without correlation id that no flow event points to (e.g. rpd ops
+        # without an api) can't be linked at all
+        flow_kernels = {
+            (event.pid, event.tid, event.ts)
+            for links in op_links.values()
+            for event in links
+            if event.ph == "f"
+        }
+        unmatched_kernels += sum(
+            1
+            for key, kernel in kernels.items()
+            if kernel.start <= ending_time and key not in flow_kernels
+        )
+    if missing:
+        # Kernels whose launcher is just outside the window are expected
+        correlations = {event.correlation for event in trace.ops}
+        correlations |= trace.dropped_correlations
+        unmatched_kernels += sum(1 for c in missing if c not in correlations)
+    if unmatched_kernels or unmatched_flows:
+        print(
+            f"Unable to link {unmatched_kernels} kernels to a launcher, "
+            f"{unmatched_flows} flow events without a kernel"
+        )
+
     return g
 
 
-def summarizeResults(g):
-    all_ops = {}
-    for node in g.toList():
+def summarizeResults(g, approx=False):
+    """
+    Read-only {short op name: OpSummary}, every report writer reuses it so the
+    medians and percentiles are only computed once per op.
+    With approx the median/p90/p99 come from a QuantileSketch per op instead of
+    keeping every duration (within RELATIVE_ACCURACY).
+    """
+    if approx:
+        return summarizeSketches(sketchResults(g))
+    if HAVE_NUMPY:
+        names, *columns = g.table.groupStats(shortName)
+        all_ops = {name: OpSummary(*stats) for name, *stats in zip(names, *columns)}
+    else:
+        durations = {}
+        for node in g.iterPreorder():
+            durations.setdefault(shortName(node.name), []).append(node.duration)
+        all_ops = {name: summarizeDurations(ops) for name, ops in durations.items()}
+    return MappingProxyType(all_ops)
+
+
+def sketchResults(g, relative_accuracy=RELATIVE_ACCURACY):
+    """
+    {short op name: QuantileSketch} of the op durations. Sketches of different
+    traces/ranks can be combined with QuantileSketch.merge.
+    """
+    sketches = {}
+    # One sketch lookup per distinct node name, not per node
+    by_name = {}
+    for node in g.iterPreorder():
+        sketch = by_name.get(node.name)
+        if sketch is None:
+            name = shortName(node.name)
+            sketch = sketches.get(name)
+            if sketch is None:
+                sketch = sketches[name] = QuantileSketch(relative_accuracy)
+            by_name[node.name] = sketch
+        sketch.add(node.duration)
+    return sketches
+
+
+def summarizeSketches(sketches):
+    return MappingProxyType(
+        {
+            name: OpSummary(
+                s.total,
+                s.max,
+                s.min,
+                s.quantile(0.5),
+                s.count,
+                s.quantile(0.9),
+                s.quantile(0.99),
+            )
+            for name, s in sketches.items()
+        }
+    )
+
+
+def totalsByOp(g):
+    """
+    {short op name: total duration}, much cheaper than summarizeResults as no
+    durations are kept or sorted.
+    """
+    if HAVE_NUMPY:
+        return dict(zip(*g.table.groupTotals(shortName)))
+    totals = {}
+    for node in g.iterPreorder():
         name = shortName(node.name)
-        op_total, op_max, op_min, ops, op_count = all_ops.setdefault(
-            name, [0, -1, 10000000, [], 0]
-        )
-        op_dur = node.duration
-        op_total += op_dur
-        op_max = op_max if op_max > op_dur else op_dur
-        op_min = op_min if op_min < op_dur else op_dur
-        op_count += 1
-        ops.append(op_dur)
-        all_ops[name] = [op_total, op_max, op_min, ops, op_count]
-    return all_ops
+        totals[name] = totals.get(name, 0) + node.duration
+    return totals
+
+
+def summarizeOps(g, ops):
+    """
+    {short op name: OpSummary} of the given ops only.
+    """
+    if HAVE_NUMPY:
+        names, *columns = g.table.groupStats(shortName, ops)
+        return {name: OpSummary(*stats) for name, *stats in zip(names, *columns)}
+    durations = {op: [] for op in ops}
+    for node in g.iterPreorder():
+        op_durations = durations.get(shortName(node.name))
+        if op_durations is not None:
+            op_durations.append(node.duration)
+    return {name: summarizeDurations(ops) for name, ops in durations.items() if ops}
+
+
+# Op names are cut to the width of the Operation column of the sheets
+OP_NAME_WIDTH = 45
+# Sort keys of the printed ops, from the totals of both traces
+SORT_KEYS = {
+    "total": lambda one, two: max(one, two),
+    "diff": lambda one, two: abs(one - two),
+    "rdiff": lambda one, two: abs(two - one) / max(one, 1),
+}
+
+
+def printTopOps(name_one, name_two, g_one, g_two, top, sort_by):
+    """
+    Prints the top ops shared by both traces. They are picked from the totals
+    (partial selection), only these ops are fully summarized.
+    """
+    totals_one = totalsByOp(g_one)
+    totals_two = totalsByOp(g_two)
+    shared_ops = (totals_one.keys() & totals_two.keys()) - {"top_node"}
+    key = SORT_KEYS[sort_by]
+    ops = heapq.nlargest(
+        top, shared_ops, key=lambda op: (key(totals_one[op], totals_two[op]), op)
+    )
+    printTableSumary(
+        name_one, name_two, summarizeOps(g_one, ops), summarizeOps(g_two, ops), ops
+    )
 
 
 def printTableSumary(name_one, name_two, all_ops_one, all_ops_two, ops_to_print):
+    """
+    Aligned table of the summaries of ops_to_print, in the given order, with the
+    difference and ratio of the totals like the Comparison sheet.
+    """
     # TODO: print unshared OPs
-    print(
-        f"{'':50} {name_one:7.6}{'max':5}{'min':5}{'median':8}{'count':7}"
-        f"{name_two:7.6}{'max':5}{'min':5}{'median':8}{'count':7}{'Rdiff':7}"
-    )
+    fields = ["max", "min", "median", "count"]
+    headers = ["Operation", name_one, *fields, name_two, *fields, "Diff", "Ratio"]
+
+    def cell(value):
+        return f"{value:.1f}" if isinstance(value, float) else str(value)
+
+    rows = []
     for key in ops_to_print:
         if key == "top_node":
             continue
-        median_one = getMedian(all_ops_one[key][3])
-        median_two = getMedian(all_ops_two[key][3])
-
+        one = all_ops_one[key]
+        two = all_ops_two[key]
+        rows.append(
+            [key[:OP_NAME_WIDTH]]
+            + [cell(value) for value in one[:SUMMARY_COLUMNS]]
+            + [cell(value) for value in two[:SUMMARY_COLUMNS]]
+            + [cell(one.total - two.total), f"{two.total / max(one.total, 1):.3f}"]
+        )
+    widths = [max(len(row[c]) for row in [headers] + rows) for c in range(len(headers))]
+    for row in [headers] + rows:
         print(
-            f"{key:48.45}{all_ops_one[key][0]:6}{all_ops_one[key][1]:7}"
-            f"{all_ops_one[key][2]:5}{median_one:8}{all_ops_one[key][4]:7}"
-            f"{all_ops_two[key][0]:8}{all_ops_two[key][1]:4}{all_ops_two[key][2]:5}"
-            f"{median_two:8}{all_ops_two[key][4]:7}"
-            f"{all_ops_two[key][0]/all_ops_one[key][0]:7.3}"
+            row[0].ljust(widths[0]),
+            *(value.rjust(width) for value, width in zip(row[1:], widths[1:])),
+            sep="  ",
         )
 
 
@@ -167,11 +372,8 @@ def writeSingleSummary(
     for op in keys:
         worksheet.write(r, 0, op, redge_format)
         result = results[op]
-        for c in range(len(result)):
-            value = (
-                result[c] if not isinstance(result[c], Iterable) else getMedian(result[c])
-            )
-            worksheet.write(r, c + 1, value)
+        for c in range(SUMMARY_COLUMNS):
+            worksheet.write(r, c + 1, result[c])
         r += 1
 
     # Formating
@@ -181,37 +383,57 @@ def writeSingleSummary(
 
 
 def getAllVariations(graph, keys):
-    g_as_list = graph.toList()
-    variation_dict = {}
-    for key in keys:
-        variations = {}
-        for node in g_as_list:
-            if shortName(node.name) == key:
-                # Dumb hash of just name child names together
-                variation_hash = key
-                for child in node.children:
-                    # Remove non-alphanumberic characters.
-                    # Bypass the kernellaunch ops
-                    if child.is_kernel_launch and len(child.children) == 1:
-                        s_name = shortName(child.children[0].name)
-                    else:
-                        s_name = shortName(child.name)
-                    variation_hash += "".join(c for c in s_name if c.isalnum())
-                reference, count, total_duration = variations.setdefault(
-                    variation_hash, [None, 0, 0]
-                )
-                if reference is None:
-                    reference = node
-                count += 1
-                total_duration += node.duration
-                variations[variation_hash] = [reference, count, total_duration]
-        variation_dict[key] = variations
+    """
+    {key: {variation hash: [first node, count, total duration]}} for the ops whose
+    short name is in keys. The hash is the op name followed by the alphanumeric short
+    names of its children (kernel launches replaced by their kernel).
+    Single pass over the graph, names are only shortened/cleaned once per distinct name.
+    """
+    short_names = {}
+    clean_names = {}
+
+    def short(name):
+        s_name = short_names.get(name)
+        if s_name is None:
+            s_name = short_names[name] = shortName(name)
+        return s_name
+
+    def clean(name):
+        # Remove non-alphanumberic characters.
+        c_name = clean_names.get(name)
+        if c_name is None:
+            c_name = clean_names[name] = "".join(c for c in short(name) if c.isalnum())
+        return c_name
+
+    variation_dict = {key: {} for key in keys}
+    for node in graph.iterPreorder():
+        key = short(node.name)
+        variations = variation_dict.get(key)
+        if variations is None:
+            continue
+        # Dumb hash of just name child names together
+        child_names = []
+        for child in node.children:
+            # Bypass the kernellaunch ops
+            if child.is_kernel_launch and len(child.children) == 1:
+                child = child.children[0]
+            child_names.append(clean(child.name))
+        variation_hash = key + "".join(child_names)
+        variation = variations.get(variation_hash)
+        if variation is None:
+            variations[variation_hash] = [node, 1, node.duration]
+        else:
+            variation[1] += 1
+            variation[2] += node.duration
     return variation_dict
 
 
-def writeAllVariatons(variations, workbook, name, map_sheet, map_column):
+def writeAllVariatons(variations, workbook, name, map_sheet):
+    """
+    One sheet per op with its variations, returns the sheet names for the map sheet.
+    """
     sheet_num = 0
-    worksheet_map = {}
+    worksheet_names = []
     for key in variations:
         # if len(variations[key].keys()) < 2:
         #   # Just one variation, skip.
@@ -221,7 +443,7 @@ def writeAllVariatons(variations, workbook, name, map_sheet, map_column):
         worksheet_name = f"{sheet_num}_{name}_{key_clean}"
         sheet_num += 1
         worksheet = workbook.add_worksheet(worksheet_name[:28])
-        worksheet_map[key] = worksheet_name[:28]
+        worksheet_names.append(worksheet_name[:28])
         worksheet.set_column(0, 15, 35)
 
         r = 0
@@ -245,23 +467,25 @@ def writeAllVariatons(variations, workbook, name, map_sheet, map_column):
                 c_duration = child_resolved.duration
                 worksheet.write(r, c, c_name)
                 worksheet.write(r, c + 1, f"Duration: {c_duration}")
-                if "BW" in child_resolved.traceEvent.keys():
-                    bw = child_resolved.traceEvent["BW"]
+                if child_resolved.bw is not None:
+                    bw = child_resolved.bw
                     worksheet.write(r, c + 2, f"BW efficiency: {bw}")
                 r += 1
             r += 6
 
         worksheet.write_url(r, 0, f"internal:{map_sheet.get_name()}!A1", string="Index")
 
-    r = 0
-    for key in worksheet_map.keys():
-        map_sheet.write_url(
-            r,
-            map_column,
-            f"internal:{worksheet_map[key]}!A1",
-            string=f"{worksheet_map[key]}",
-        )
-        r += 1
+    return worksheet_names
+
+
+def writeVariationMap(map_sheet, columns):
+    # Row by row, the workbook is written in constant_memory mode
+    for r, names in enumerate(zip_longest(*columns)):
+        for c, worksheet_name in enumerate(names):
+            if worksheet_name is not None:
+                map_sheet.write_url(
+                    r, c, f"internal:{worksheet_name}!A1", string=worksheet_name
+                )
 
 
 def writeBandwidthSheet(g, name, workbook, bold_format):
@@ -279,10 +503,10 @@ def writeBandwidthSheet(g, name, workbook, bold_format):
     for kernel in kernels:
         c = 0
         worksheet.write(r, c, kernel.name)
-        value = kernel.traceEvent["BW"] if "BW" in kernel.traceEvent.keys() else " "
+        value = kernel.bw if kernel.bw is not None else " "
         worksheet.write(r, c + 1, value)
         worksheet.write(r, c + 2, kernel.parent.parent.name)
-        sizes = kernel.parent.parent.traceEvent["args"]["Input Dims"]
+        sizes = kernel.parent.parent.args["Input Dims"]
         worksheet.write(r, c + 3, str(sizes))
         r += 1
 
@@ -291,8 +515,24 @@ def writeBandwidthSheet(g, name, workbook, bold_format):
     worksheet.set_column(1, 1, 6)
 
 
+def kernelType(name):
+    # 0: elementwise, 1: blas, 2: other
+    if name.startswith("ampere") or name.startswith("Cijk") or "cutlass" in name:
+        return 1
+    elif "elementwise" in name:
+        return 0
+    return 2
+
+
 def summarizeResultsKernelBreakdown(graph):
-    ops = graph.toList()
+    if HAVE_NUMPY:
+        table = graph.table
+        types = table.mapNames(kernelType)
+        # CPU ops go in their own bucket
+        types[~table.is_kernel] = 3
+        return tuple(table.sumBy(types, 4))
+
+    ops = graph.iterPreorder()
     el_kernels = 0
     math_kernels = 0
     other_kernels = 0
@@ -338,8 +578,14 @@ def writeKernelBreakdowns(
         r += 1
 
 
-def writeXLSX(name_one, name_two, g_one, g_two, args):
-    workbook = xlsxwriter.Workbook(f"report_{name_one}_{name_two}.xlsx")
+def writeXLSX(
+    name_one, name_two, g_one, g_two, args, summarized_ops_one, summarized_ops_two
+):
+    # Rows are flushed to disk as soon as the next one is started, every sheet must be
+    # written strictly row by row.
+    workbook = xlsxwriter.Workbook(
+        f"report_{name_one}_{name_two}.xlsx", {"constant_memory": True}
+    )
     worksheet_comparison = workbook.add_worksheet("Comparison")
 
     # Formats
@@ -369,10 +615,6 @@ def writeXLSX(name_one, name_two, g_one, g_two, args):
         "Diff ratio",
     ]
 
-    # Process data
-    summarized_ops_one = summarizeResults(g_one)
-    summarized_ops_two = summarizeResults(g_two)
-
     shared_ops = set(summarized_ops_one.keys()).intersection(
         set(summarized_ops_two.keys())
     )
@@ -390,37 +632,26 @@ def writeXLSX(name_one, name_two, g_one, g_two, args):
         )
         h += 1
 
-    # Write basic info
+    # Write basic info and comparison info, one whole row at a time
     r = 1
+    c = (SUMMARY_COLUMNS * 2) + 1
     for op in shared_ops:
-        op_summary = summarized_ops_one[op] + summarized_ops_two[op]
+        one = summarized_ops_one[op]
+        two = summarized_ops_two[op]
+        op_summary = one[:SUMMARY_COLUMNS] + two[:SUMMARY_COLUMNS]
         worksheet_comparison.write(r, 0, op, redge_format)
-        for c in range(len(op_summary)):
-            value = (
-                op_summary[c]
-                if not isinstance(op_summary[c], Iterable)
-                else getMedian(op_summary[c])
-            )
-            worksheet_comparison.write(r, c + 1, value)
-        r += 1
-
-    # Write comparison info
-    r = 1
-    for op in shared_ops:
-        c = (len(summarized_ops_one[op]) * 2) + 1
-        diff_total = summarized_ops_one[op][0] - summarized_ops_two[op][0]
-        diff_median = getMedian(summarized_ops_one[op][3]) - getMedian(
-            summarized_ops_two[op][3]
-        )
+        for i in range(len(op_summary)):
+            worksheet_comparison.write(r, i + 1, op_summary[i])
+        diff_total = one.total - two.total
+        diff_median = one.median - two.median
         # XXX: zero duration ops are a problem...
-        diff_ratio = summarized_ops_two[op][0] / max(summarized_ops_one[op][0], 1)
+        diff_ratio = two.total / max(one.total, 1)
         worksheet_comparison.write(r, c, diff_total, ledge_format)
         worksheet_comparison.write(r, c + 1, diff_median)
         worksheet_comparison.write(r, c + 2, diff_ratio)
         r += 1
 
     # Conditional Formating
-    c = (len(summarized_ops_one[op]) * 2) + 1
     worksheet_comparison.conditional_format(
         1, c, r, c + 1, {"type": "data_bar", "bar_color": "#FF555A"}
     )
@@ -479,14 +710,82 @@ def writeXLSX(name_one, name_two, g_one, g_two, args):
     # Variation Map
     if args.variations:
         worksheet_variation = workbook.add_worksheet(f"Variation_Map")
-        var = getAllVariations(g_one, g_one.getNames(True, shortName))
-        writeAllVariatons(var, workbook, name_one, worksheet_variation, 0)
-        var = getAllVariations(g_two, g_two.getNames(True, shortName))
-        writeAllVariatons(var, workbook, name_two, worksheet_variation, 1)
+        columns = []
+        for g, name in ((g_one, name_one), (g_two, name_two)):
+            var = getAllVariations(g, g.getNames(True, shortName))
+            columns.append(writeAllVariatons(var, workbook, name, worksheet_variation))
+        writeVariationMap(worksheet_variation, columns)
         worksheet_variation.set_column(0, 1, 45)
 
     workbook.close()
 
+
+def exportTables(
+    name_one, name_two, g_one, g_two, args, summarized_ops_one, summarized_ops_two
+):
+    """
+    Same results as the xlsx report as (table, headers, rows) for the csv/npz
+    exports. Traces are referred to as "first" and "second", their names and files
+    are in the "traces" table. Rows are generated lazily.
+    """
+    roles = (
+        ("first", g_one, summarized_ops_one, args.first),
+        ("second", g_two, summarized_ops_two, args.second),
+    )
+    yield "traces", ["trace", "name", "iteration", "file"], (
+        (role, *trace_args) for role, _, _, trace_args in roles
+    )
+
+    fields = list(OpSummary._fields)
+    shared_ops = sorted(
+        set(summarized_ops_one).intersection(summarized_ops_two) - {"top_node"}
+    )
+
+    def comparisonRows():
+        for op in shared_ops:
+            one = summarized_ops_one[op]
+            two = summarized_ops_two[op]
+            yield (
+                op,
+                *one,
+                *two,
+                one.total - two.total,
+                one.median - two.median,
+                two.total / max(one.total, 1),
+            )
+
+    yield "comparison", (
+        ["op"]
+        + [f"first_{field}" for field in fields]
+        + [f"second_{field}" for field in fields]
+        + ["diff_total", "diff_median", "diff_ratio"]
+    ), comparisonRows()
+
+    yield "ops", ["trace", "op"] + fields, (
+        (role, op, *summarized_ops[op])
+        for role, _, summarized_ops, _ in roles
+        for op in sorted(summarized_ops)
+        if op != "top_node"
+    )
+
+    if args.kernel_stats:
+        yield "kernels", ["trace", "elementwise", "blas", "other", "cpu"], (
+            (role, *summarizeResultsKernelBreakdown(g)) for role, g, _, _ in roles
+        )
+    if args.calculate_elementwise_eff:
+        yield "bandwidth", ["trace", "kernel", "gbps", "caller", "size"], (
+            (
+                role,
+                kernel.name,
+                kernel.bw,
+                kernel.parent.parent.name,
+                str(kernel.parent.parent.args["Input Dims"]),
+            )
+            for role, g, _, _ in roles
+            for kernel in g.nameSearch("elementwise_kernel")
+        )
+
+
 def match_rocm_cuda_kernels(g_one, g_two):
     g_one_cpu_ops =  [g_one.top_node]
     g_two_cpu_ops =  [g_two.top_node]
@@ -555,13 +854,97 @@ def main():
         default=False,
         help="Only creates a sheet with aligned ROCm and CUDA kernel names"
         )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse each trace and to build its per thread "
+        "op trees.",
+    )
+    parser.add_argument(
+        "--num-iterations",
+        type=int,
+        default=1,
+        help="Number of iterations to analyze starting at the given iteration number.",
+    )
+    parser.add_argument(
+        "--approx-stats",
+        action="store_true",
+        default=False,
+        help="Computes the median and percentiles with a bounded memory sketch, "
+        f"within {RELATIVE_ACCURACY:.0%} of the exact value.",
+    )
+    parser.add_argument(
+        "--load-workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing the traces in parallel (default: number of "
+        "CPUs), 1 parses them in turn.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Directory where the parsed graphs are cached between runs (needs NumPy).",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Always reparse the traces, without reading or writing the cache.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE >> 20,
+        help="Size of the graph cache in MB, the least recently used graphs are "
+        "removed past it.",
+    )
+    parser.add_argument(
+        "--format",
+        nargs="+",
+        choices=FORMATS,
+        default=["xlsx"],
+        help="Report formats: xlsx, csv (one report_<first>_<second>_<table>.csv per "
+        "table) and/or npz (columnar NumPy arrays, see trace_export.loadNPZ).",
+    )
+    parser.add_argument(
+        "--print",
+        action="store_true",
+        default=False,
+        help="Prints the top ops to the terminal instead of writing a report.",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Number of ops printed with --print.",
+    )
+    parser.add_argument(
+        "--sort-by",
+        choices=list(SORT_KEYS),
+        default="total",
+        help="Ops printed with --print: largest total of either trace, largest "
+        "absolute difference of the totals or largest relative difference.",
+    )
     args = parser.parse_args()
 
     iteration_one = int(args.first[1]) if args.first[1] != "None" else None
     iteration_two = int(args.second[1]) if args.first[1] != "None" else None
 
-    g_one = processJson(args.first[2], iteration_one)
-    g_two = processJson(args.second[2], iteration_two)
+    cache = None
+    if not args.no_cache:
+        if HAVE_NUMPY:
+            cache = GraphCache(args.cache_dir, args.cache_size << 20)
+        else:
+            print("Graph cache disabled, it needs NumPy")
+
+    g_one, g_two = loadTraces(
+        [(args.first[2], iteration_one), (args.second[2], iteration_two)],
+        args.num_iterations,
+        args.workers,
+        cache,
+        args.load_workers,
+    )
 
     if args.match_kernels_only:
         match_rocm_cuda_kernels(g_one, g_two)
@@ -572,25 +955,33 @@ def main():
         g_one.rollupKernelTime()
         g_two.rollupKernelTime()
 
+    if args.print:
+        printTopOps(
+            args.first[0], args.second[0], g_one, g_two, args.top, args.sort_by
+        )
+        return
+
     if args.calculate_elementwise_eff:
         # Calculates BW efficiency for some kernels.
         calcAllBW(g_one)
         calcAllBW(g_two)
 
-    if False:
-        # TODO: Print to command line more efficently
-        all_ops_one = summarizeResults(g_one)
-        all_ops_two = summarizeResults(g_two)
-
-        shared_ops = set(all_ops_one.keys()).intersection(set(all_ops_two.keys()))
-        divergent_ops = set(all_ops_one.keys()).symmetric_difference(
-            set(all_ops_two.keys())
-        )
-        printTableSumary(
-            args.first[0], args.second[0], all_ops_one, all_ops_two, shared_ops
-        )
-
-    writeXLSX(args.first[0], args.second[0], g_one, g_two, args)
+    if args.approx_stats:
+        print(f"Approximate op statistics: median/p90/p99 within {RELATIVE_ACCURACY:.0%}")
+    all_ops_one = summarizeResults(g_one, args.approx_stats)
+    all_ops_two = summarizeResults(g_two, args.approx_stats)
+
+    report = (args.first[0], args.second[0], g_one, g_two, args, all_ops_one, all_ops_two)
+    prefix = f"report_{args.first[0]}_{args.second[0]}"
+    if "xlsx" in args.format:
+        writeXLSX(*report)
+    if "csv" in args.format:
+        writeCSV(prefix, exportTables(*report))
+    if "npz" in args.format:
+        if HAVE_NUMPY:
+            writeNPZ(f"{prefix}.npz", exportTables(*report))
+        else:
+            print("npz report skipped, it needs NumPy")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+
+from trace_graph import CATEGORIES, Graph, Node
+from trace_reader import PARSER_VERSION
+from trace_table import np
+from trace_utils import pausedGC
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "trace_analyzer")
+# Bound on the total size of the cached graphs, the least recently used entries are
+# removed past it
+DEFAULT_MAX_SIZE = 1 << 30
+
+# Bytes hashed at the start, middle and end of a trace to identify its content
+SAMPLE_SIZE = 1 << 20
+
+# One row per node in pre-order, without the top node. parent is the row of the
+# parent in EventTable numbering (0 is the top node, row i is node i - 1), the other
+# id columns index the string/value tables stored next to the rows.
+ROW_DTYPE = [
+    ("start", "<i8"),
+    ("dur", "<i8"),
+    ("parent", "<i8"),
+    ("name", "<i4"),
+    ("cat", "<i4"),
+    ("thread", "<i4"),
+    ("args", "<i4"),
+]
+
+
+def traceKey(file_name, iteration, num_iterations):
+    """
+    Cache key of a trace and iteration window: file size, mtime, a hash of samples of
+    the content and the parser version.
+    """
+    stat = os.stat(file_name)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(
+        repr(
+            (stat.st_size, stat.st_mtime_ns, iteration, num_iterations, PARSER_VERSION)
+        ).encode()
+    )
+    with open(file_name, "rb") as f:
+        for offset in (0, stat.st_size // 2, stat.st_size - SAMPLE_SIZE):
+            f.seek(max(offset, 0))
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def graphToArrays(g):
+    """
+    Compact columnar copy of a graph: a structured NumPy array with one row per node
+    and a JSON-able dict with the names, categories, (pid, tid) and input dims.
+    """
+    table = g.table
+    nodes = table.nodes[1:]
+    thread_ids = {}
+    # Same shapes repeat a lot, each distinct "Input Dims" is only stored once
+    dims_ids = {}
+    args = []
+    rows = np.empty(len(nodes), ROW_DTYPE)
+    rows["start"] = table.start[1:]
+    rows["dur"] = table.dur[1:]
+    rows["parent"] = table.parent[1:]
+    rows["name"] = table.name_id[1:]
+    rows["cat"] = table.cat[1:]
+    rows["thread"] = [
+        thread_ids.setdefault((n.pid, n.tid), len(thread_ids)) for n in nodes
+    ]
+    arg_ids = []
+    for n in nodes:
+        if n.args is None:
+            arg_ids.append(-1)
+        else:
+            dims = n.args["Input Dims"]
+            dims_id = dims_ids.setdefault(json.dumps(dims), len(args))
+            if dims_id == len(args):
+                args.append(dims)
+            arg_ids.append(dims_id)
+    rows["args"] = arg_ids
+    meta = {
+        "names": table.names,
+        "categories": list(CATEGORIES),
+        "threads": list(thread_ids),
+        "input_dims": args,
+    }
+    return rows, meta
+
+
+def graphFromArrays(rows, meta):
+    names = meta["names"]
+    categories = meta["categories"]
+    threads = meta["threads"]
+    args = [{"Input Dims": dims} for dims in meta["input_dims"]]
+    with pausedGC():
+        nodes = [
+            Node.fromFields(
+                names[name],
+                start,
+                dur,
+                categories[cat],
+                *threads[thread],
+                None if arg < 0 else args[arg],
+            )
+            for start, dur, name, cat, thread, arg in zip(
+                rows["start"].tolist(),
+                rows["dur"].tolist(),
+                rows["name"].tolist(),
+                rows["cat"].tolist(),
+                rows["thread"].tolist(),
+                rows["args"].tolist(),
+            )
+        ]
+        return Graph.fromPreorder(nodes, rows["parent"].tolist())
+
+
+class GraphCache:
+    """
+    Directory of built graphs, one <key>.npy and <key>.json per trace and iteration
+    window. A hit skips the parsing and the tree sweep but still builds every Node
+    again from the rows (graphFromArrays), the .npy is read whole. A small
+    <path hash>.ref file remembers the last key of each trace path so stale entries
+    are removed when the trace changes.
+    Past max_size bytes the least recently used entries (by the .npy mtime, bumped on
+    every hit) are evicted when a new one is saved.
+    Hits, misses, invalidations and evictions are reported on stdout.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+
+    def _path(self, name, ext):
+        return os.path.join(self.cache_dir, name + ext)
+
+    def _ref(self, file_name, iteration, num_iterations):
+        source = repr((os.path.abspath(file_name), iteration, num_iterations))
+        return self._path(
+            hashlib.blake2b(source.encode(), digest_size=16).hexdigest(), ".ref"
+        )
+
+    def load(self, file_name, iteration=None, num_iterations=1):
+        """
+        Cached graph of the trace window, None on a miss.
+        """
+        key = traceKey(file_name, iteration, num_iterations)
+        ref = self._ref(file_name, iteration, num_iterations)
+        if os.path.exists(ref):
+            with open(ref) as f:
+                old_key = f.read().strip()
+            if old_key != key:
+                self._remove(old_key)
+                os.remove(ref)
+                print(f"Cache invalidated for {file_name}: the trace changed")
+        try:
+            rows = np.load(self._path(key, ".npy"))
+            with open(self._path(key, ".json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            print(f"Cache miss for {file_name}")
+            return None
+        print(f"Cache hit for {file_name} ({self._path(key, '.npy')})")
+        try:
+            os.utime(self._path(key, ".npy"))
+        except OSError:
+            pass
+        return graphFromArrays(rows, meta)
+
+    def save(self, g, file_name, iteration=None, num_iterations=1):
+        key = traceKey(file_name, iteration, num_iterations)
+        rows, meta = graphToArrays(g)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Written under a temporary name first so a crash never leaves half an entry
+            for ext, write in (
+                (".npy", lambda f: np.save(f, rows)),
+                (".json", lambda f: f.write(json.dumps(meta).encode())),
+            ):
+                path = self._path(key, ext)
+                with open(path + ".tmp", "wb") as f:
+                    write(f)
+                os.replace(path + ".tmp", path)
+            with open(self._ref(file_name, iteration, num_iterations), "w") as f:
+                f.write(key)
+            self._evict(key)
+        except OSError as e:
+            print(f"Unable to cache {file_name}: {e}")
+
+    def _entries(self):
+        # (last use, size, key) of every cached graph
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            key = name[: -len(".npy")]
+            try:
+                stat = os.stat(self._path(key, ".npy"))
+                size = stat.st_size + os.path.getsize(self._path(key, ".json"))
+            except OSError:
+                # Being written or removed by another process
+                continue
+            entries.append((stat.st_mtime, size, key))
+        return entries
+
+    def _evict(self, keep):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = set()
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            evicted.add(key)
+            total -= size
+        if not evicted:
+            return
+        print(f"Cache evicted {len(evicted)} least recently used entries")
+        # The .ref files of the evicted entries are stale too
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".ref"):
+                ref = os.path.join(self.cache_dir, name)
+                try:
+                    with open(ref) as f:
+                        if f.read().strip() in evicted:
+                            os.remove(ref)
+                except OSError:
+                    pass
+
+    def _remove(self, key):
+        for ext in (".npy", ".json"):
+            try:
+                os.remove(self._path(key, ext))
+            except FileNotFoundError:
+                pass
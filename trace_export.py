@@ -0,0 +1,94 @@
+import csv
+import json
+import struct
+import zipfile
+
+from trace_table import np
+
+FORMATS = ("xlsx", "csv", "npz")
+
+# Fixed part of a zip local file header, the name and extra field lengths are its
+# last two fields.
+_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+
+
+def writeCSV(prefix, tables):
+    """
+    One <prefix>_<table>.csv per (table, headers, rows), rows are streamed to the
+    file as they are produced. None is written as an empty cell.
+    """
+    for table, headers, rows in tables:
+        with open(f"{prefix}_{table}.csv", "w", newline="", buffering=1 << 20) as f:
+            writer = csv.writer(f)
+            writer.writerow(headers)
+            writer.writerows(rows)
+
+
+def writeNPZ(file_name, tables):
+    """
+    Uncompressed .npz with one array per column, named <table>.<column>.
+    String columns are int32 ids into a single string table: the UTF-8 bytes of
+    every distinct string in "strings.data" and their [start, end) bounds in
+    "strings.offsets". None in a numeric column is NaN. The "schema" member is the
+    JSON {table: [[column, "str" or "num"], ...]}. See loadNPZ.
+    """
+    string_ids = {}
+    arrays = {}
+    schema = {}
+    for table, headers, rows in tables:
+        columns = list(zip(*rows)) or [()] * len(headers)
+        schema[table] = []
+        for header, values in zip(headers, columns):
+            key = f"{table}.{header}"
+            if any(isinstance(value, str) for value in values):
+                arrays[key] = np.array(
+                    [string_ids.setdefault(value, len(string_ids)) for value in values],
+                    np.int32,
+                )
+                schema[table].append([header, "str"])
+            else:
+                if None in values:
+                    values = [np.nan if value is None else value for value in values]
+                arrays[key] = np.array(values, np.float64 if not values else None)
+                schema[table].append([header, "num"])
+    encoded = [string.encode() for string in string_ids]
+    arrays["strings.data"] = np.frombuffer(b"".join(encoded), np.uint8)
+    arrays["strings.offsets"] = np.cumsum([0] + [len(e) for e in encoded], dtype=np.int64)
+    arrays["schema"] = np.frombuffer(json.dumps(schema).encode(), np.uint8)
+    np.savez(file_name, **arrays)
+
+
+def loadNPZ(file_name):
+    """
+    ({table: {column: array}}, strings) of a file written by writeNPZ. The columns
+    are memory mapped read-only, string columns hold indexes into strings.
+    """
+    members = {}
+    with open(file_name, "rb") as f, zipfile.ZipFile(f) as z:
+        for info in z.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{file_name}: {info.filename} is compressed")
+            f.seek(info.header_offset)
+            header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+            f.seek(info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1])
+            if np.lib.format.read_magic(f) == (1, 0):
+                read_header = np.lib.format.read_array_header_1_0
+            else:
+                read_header = np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            if np.prod(shape) == 0:
+                array = np.empty(shape, dtype)
+            else:
+                order = "F" if fortran_order else "C"
+                array = np.memmap(file_name, dtype, "r", f.tell(), shape, order)
+            members[info.filename[: -len(".npy")]] = array
+
+    data = members.pop("strings.data").tobytes()
+    offsets = members.pop("strings.offsets").tolist()
+    strings = [data[start:end].decode() for start, end in zip(offsets, offsets[1:])]
+    schema = json.loads(members.pop("schema").tobytes())
+    tables = {
+        table: {column: members[f"{table}.{column}"] for column, _ in columns}
+        for table, columns in schema.items()
+    }
+    return tables, strings
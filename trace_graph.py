@@ -1,29 +1,152 @@
+import heapq
+import sys
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+from trace_table import EventTable
+
+
+KERNEL_CATEGORIES = (
+    "Kernel",
+    "KernelExecution",
+    "FillBuffer",
+    "Memset",
+    "kernel",
+    "Memcpy",
+    "gpu_memcpy",
+    "gpu_memset",
+)
+
+
+def sweepKey(start, duration):
+    # Zero duration intervals first on equal starts, then the longest first
+    return start, duration > 0, -duration
+
+
+def sweepParents(intervals):
+    """
+    Containment hierarchy of a list of (start, end, duration) intervals.
+    Returns the indices sorted by sweepKey and the parent index of each interval (-1
+    for top level ones, None for the ones dropped for starting before 0).
+    Ties give the same tree as Node.addChild on start ordered input: a zero duration
+    interval at t stays in an earlier interval ending at t when one contains it,
+    otherwise the intervals starting at t adopt it, like addChild moves the children
+    a new node contains under it.
+    """
+    order = sorted(
+        range(len(intervals)), key=lambda i: sweepKey(intervals[i][0], intervals[i][2])
+    )
+    parents = [None] * len(intervals)
+    stack = []
+    # Zero duration intervals starting at zeros_start, they can still be adopted
+    zeros = []
+    zeros_start = None
+    for i in order:
+        start, end, duration = intervals[i]
+        if start < 0:
+            # Same as addChild, nodes outside the top node are dropped
+            continue
+        while stack and not (
+            start >= intervals[stack[-1]][0] and end <= intervals[stack[-1]][1]
+        ):
+            stack.pop()
+        parent = stack[-1] if stack else -1
+        if duration == 0:
+            if zeros_start != start:
+                zeros = []
+                zeros_start = start
+            zeros.append(i)
+        elif zeros_start == start:
+            for z in zeros:
+                if parents[z] == parent:
+                    parents[z] = i
+        parents[i] = parent
+        stack.append(i)
+    return order, parents
+
+
+KERNEL_LAUNCHES = (
+    "hipExtModuleLaunchKernel",
+    "hipLaunchKernel",
+    "cudaLaunchKernel",
+)
+
+# Category strings are stored on the nodes as small integer codes. The kernel
+# categories are registered first so a code below len(KERNEL_CATEGORIES) is a kernel.
+CATEGORIES = list(KERNEL_CATEGORIES)
+_CATEGORY_CODES = {cat: code for code, cat in enumerate(CATEGORIES)}
+
+
+def categoryCode(cat):
+    code = _CATEGORY_CODES.get(cat)
+    if code is None:
+        code = _CATEGORY_CODES[cat] = len(CATEGORIES)
+        CATEGORIES.append(cat)
+    return code
+
+
 class Node:
+    """
+    Compact node: only what the analyses read is kept from the trace event.
+    args is None unless the event had "Input Dims" (or calcAllBW parsed them) and
+    bw is set by calcAllBW for elementwise kernels.
+    """
+
+    __slots__ = (
+        "name",
+        "start",
+        "end",
+        "duration",
+        "kernel_duration",
+        "children",
+        "parent",
+        "pid",
+        "tid",
+        "cat_code",
+        "is_kernel",
+        "is_kernel_launch",
+        "args",
+        "bw",
+    )
+
     def __init__(self, traceEvent):
+        self._init(
+            traceEvent["name"],
+            int(traceEvent["ts"]),
+            int(traceEvent["dur"]),
+            traceEvent.get("cat", ""),
+            traceEvent.get("pid"),
+            traceEvent.get("tid"),
+            traceEvent.get("args"),
+        )
+
+    @classmethod
+    def fromFields(cls, name, start, duration, cat="", pid=None, tid=None, args=None):
+        node = cls.__new__(cls)
+        node._init(name, start, duration, cat, pid, tid, args)
+        return node
 
-        self.name = traceEvent["name"]
-        self.start = int(traceEvent["ts"])
-        self.end = self.start + int(traceEvent["dur"])
-        self.duration = int(traceEvent["dur"])
+    def _init(self, name, start, duration, cat, pid, tid, args):
+        self.name = sys.intern(name)
+        self.start = start
+        self.end = start + duration
+        self.duration = duration
+        self.kernel_duration = 0
         self.children = []
         self.parent = None
-        self.cat = traceEvent.setdefault("cat", "")
-        self.is_kernel = traceEvent.setdefault("cat", "") in (
-            "Kernel",
-            "KernelExecution",
-            "FillBuffer",
-            "Memset",
-            "kernel",
-            "Memcpy",
-            "gpu_memcpy",
-            "gpu_memset",
-        )
-        self.is_kernel_launch = self.name in (
-            "hipExtModuleLaunchKernel",
-            "hipLaunchKernel",
-            "cudaLaunchKernel",
-        )
-        self.traceEvent = traceEvent
+        self.pid = pid
+        self.tid = tid
+        self.cat_code = categoryCode(cat)
+        self.is_kernel = self.cat_code < len(KERNEL_CATEGORIES)
+        self.is_kernel_launch = name in KERNEL_LAUNCHES
+        self.args = None
+        if args and "Input Dims" in args:
+            self.args = {"Input Dims": args["Input Dims"]}
+        self.bw = None
+
+    @property
+    def cat(self):
+        return CATEGORIES[self.cat_code]
 
     def isInside(self, node) -> bool:
         if isinstance(node, int):
@@ -69,57 +192,73 @@ class Node:
         else:
             print("XXX: Searching for something outside iteration")
 
+    def iterPreorder(self, skip=None):
+        """
+        Yields the subtree in pre-order (children in order) with an explicit stack.
+        Nodes for which skip(node) is true are left out together with their subtree.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if skip is not None and skip(node):
+                continue
+            yield node
+            stack.extend(reversed(node.children))
+
+    def iterPostorder(self, skip=None):
+        """
+        Yields the subtree in post-order, every node after all its children.
+        Nodes for which skip(node) is true are left out together with their subtree.
+        """
+        if skip is not None and skip(self):
+            return
+        stack = [(self, iter(self.children))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if skip is None or not skip(child):
+                    stack.append((child, iter(child.children)))
+                    break
+            else:
+                stack.pop()
+                yield node
+
+    def iterFiltered(self, predicate, skip=None):
+        """
+        Pre-order nodes of the subtree for which predicate(node) is true.
+        """
+        return filter(predicate, self.iterPreorder(skip))
+
     def nameSearch(self, name: str):
-        r_list = []
-        if name in self.name:
-            r_list.append(self)
-        for child in self.children:
-            r_list.extend(child.nameSearch(name))
-        return r_list
+        return list(self.iterFiltered(lambda node: name in node.name))
 
     def toList(self):
-        r_list = []
-        r_list.append(self)
-        for child in self.children:
-            r_list.extend(child.toList())
-        return r_list
+        return list(self.iterPreorder())
 
     def getNames(self, no_kernels, name_changer):
         # TODO no_kernels
-        r_list = []
-        if self.is_kernel:
-            return r_list
-        name = self.name if name_changer is None else name_changer(self.name)
-        r_list.append(name)
-        for child in self.children:
-            r_list.extend(child.getNames(no_kernels, name_changer))
-        return r_list
+        nodes = self.iterPreorder(skip=lambda node: node.is_kernel)
+        if name_changer is None:
+            return [node.name for node in nodes]
+        return [name_changer(node.name) for node in nodes]
 
     def rollupKernelTime(self):
-        kernel_dur = 0
         if self.is_kernel:
             return self.duration
-        for child in self.children:
-            kernel_dur += child.rollupKernelTime()
-        self.kernel_duration = kernel_dur
-        self.duration += kernel_dur
-        return kernel_dur
+        # Children first, so their kernel_duration is already rolled up
+        for node in self.iterPostorder(skip=lambda node: node.is_kernel):
+            kernel_dur = 0
+            for child in node.children:
+                kernel_dur += child.duration if child.is_kernel else child.kernel_duration
+            node.kernel_duration = kernel_dur
+            node.duration += kernel_dur
+        return self.kernel_duration
 
     def allKernels(self):
-        r_list = []
-        if self.is_kernel:
-            r_list.append(self)
-        for child in self.children:
-            r_list.extend(child.allKernels())
-        return r_list
+        return list(self.iterFiltered(lambda node: node.is_kernel))
 
     def allCPUOps(self):
-        r_list = []
-        if not self.is_kernel:
-            r_list.append(self)
-        for child in self.children:
-            r_list.extend(child.allCPUOps())
-        return r_list
+        return list(self.iterFiltered(lambda node: not node.is_kernel))
 
     ## TODO: Also add similar function to class Graph when this function
     ## becomes more stable
@@ -130,21 +269,24 @@ class Node:
         they have at least a direct child being kernel launch
         '''
         r_list = []
-        local_list = []
-        for child in self.children:
-            if not child.is_kernel_launch:
-                r_list.extend(child.allCPUOpKernelPairs())
-            else:
+        # Post-order keeps the pairs of the descendants before the op itself
+        for node in self.iterPostorder(
+            skip=lambda node: node is not self and node.is_kernel_launch
+        ):
+            local_list = []
+            for child in node.children:
+                if not child.is_kernel_launch:
+                    continue
                 if len(child.children) > 0:
                     for c in child.children:
                         if c.is_kernel:
                             local_list.append(c)
                 else:
                     print("%s is kernel launch but does not have kernel launched" %(child.name))
-                    print("Its parent is %s. The start time is %d, duration is %d" %(self.parent.name, self.start, self.duration))
-                    print(self)
-        if len(local_list) > 0:
-            r_list.append((self, local_list))
+                    print("Its parent is %s. The start time is %d, duration is %d" %(node.parent.name, node.start, node.duration))
+                    print(node)
+            if len(local_list) > 0:
+                r_list.append((node, local_list))
         return r_list
 
 
@@ -163,34 +305,194 @@ class Graph:
         )
         tn.end = float("inf")
         self.top_node = tn
+        # (pid, tid) -> top level nodes of that thread, all children of top_node
+        self.trees = {}
+        # (pid, tid) -> (starts, nodes) all nodes of the thread in pre-order, which
+        # for nested events is sorted by start time
+        self.index = {}
+        self._table = None
 
     def __str__(self):
         return "Top Node: " + str(self.top_node)
 
     def addNode(self, node):
+        self._table = None
         if self.top_node is None:
             self.top_node = node
         else:
             self.top_node.addChild(node)
 
-    def search(self, time):
-        return self.top_node.search(time)
+    def addNodes(self, nodes, workers=None):
+        """
+        Builds the containment tree for a batch of nodes in O(n log n).
+        Each (pid, tid) gets its own subtree so events from different threads or
+        streams never nest into each other. Nodes are swept in start order keeping a
+        stack of the currently open ancestors (see sweepParents), for nested events
+        this gives the same parents as calling addNode on each of them in start order.
+        With workers > 1 the threads are swept in a process pool.
+        """
+        self._table = None
+        threads = {}
+        for node in nodes:
+            threads.setdefault((node.pid, node.tid), []).append(node)
 
-    def nameSearch(self, name):
-        return self.top_node.nameSearch(name)
+        intervals = [[(n.start, n.end, n.duration) for n in t] for t in threads.values()]
+        if workers is not None and workers > 1 and len(threads) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                sweeps = list(pool.map(sweepParents, intervals))
+        else:
+            sweeps = map(sweepParents, intervals)
 
-    def toList(self):
+        new_roots = []
+        for key, thread_nodes, (order, parents) in zip(threads, threads.values(), sweeps):
+            roots = []
+            for i in order:
+                node = thread_nodes[i]
+                if parents[i] is None:
+                    continue
+                if parents[i] < 0:
+                    node.parent = self.top_node
+                    roots.append(node)
+                else:
+                    node.parent = thread_nodes[parents[i]]
+                    node.parent.children.append(node)
+            self.trees.setdefault(key, []).extend(roots)
+            new_roots.append(roots)
+
+            indexed = [thread_nodes[i] for i in order if parents[i] is not None]
+            if key in self.index:
+                indexed = list(
+                    heapq.merge(
+                        self.index[key][1],
+                        indexed,
+                        key=lambda n: sweepKey(n.start, n.duration),
+                    )
+                )
+            self.index[key] = ([n.start for n in indexed], indexed)
+        self.top_node.children = list(
+            heapq.merge(self.top_node.children, *new_roots, key=lambda n: n.start)
+        )
+
+    @classmethod
+    def fromPreorder(cls, nodes, parents):
+        """
+        Rebuilds a graph saved as its nodes in pre-order (without the top node) and
+        the pre-order row of each node's parent, row 0 being the top node (the same
+        layout as EventTable). Kernels are linked but, as in buildGraph, left out of
+        the per thread trees and index.
+        """
+        g = cls()
+        rows = [g.top_node]
+        rows.extend(nodes)
+        threads = {}
+        for node, parent in zip(nodes, parents):
+            node.parent = rows[parent]
+            node.parent.children.append(node)
+            if node.is_kernel:
+                continue
+            key = (node.pid, node.tid)
+            if parent == 0:
+                g.trees.setdefault(key, []).append(node)
+            threads.setdefault(key, []).append(node)
+        for key, thread_nodes in threads.items():
+            g.index[key] = ([n.start for n in thread_nodes], thread_nodes)
+        return g
+
+    def copy(self):
+        """
+        Graph of new nodes with the same fields and tree (rolled up kernel times and
+        bandwidths are not copied).
+        """
+        rows = {id(self.top_node): 0}
+        nodes = []
+        parents = []
+        for node in self.top_node.iterPreorder():
+            if node is self.top_node:
+                continue
+            rows[id(node)] = len(rows)
+            parents.append(rows[id(node.parent)])
+            nodes.append(
+                Node.fromFields(
+                    node.name,
+                    node.start,
+                    node.duration,
+                    node.cat,
+                    node.pid,
+                    node.tid,
+                    node.args,
+                )
+            )
+        return Graph.fromPreorder(nodes, parents)
+
+    @property
+    def table(self):
+        """
+        Columnar view of the graph (needs NumPy), built on first use. Rebuilt after
+        addNode(s)/rollupKernelTime, other changes to the nodes are not tracked.
+        """
+        if self._table is None:
+            self._table = EventTable.fromGraph(self)
+        return self._table
+
+    def _roots(self, pid, tid):
+        if pid is None and tid is None:
+            return [self.top_node]
+        return self.trees.get((pid, tid), [])
+
+    def search(self, time, pid=None, tid=None):
+        """
+        Innermost node containing time. When pid and tid are given the thread's index
+        is used: the last node starting at or before time is bisected and its
+        ancestors are walked up until one contains time. None for a thread without
+        any node.
+        """
+        if pid is None and tid is None:
+            return self.top_node.search(time)
+        if (pid, tid) not in self.index:
+            return None
+        starts, nodes = self.index[(pid, tid)]
+        i = bisect_right(starts, time) - 1
+        node = nodes[i] if i >= 0 else self.top_node
+        while node is not self.top_node and not node.isInside(time):
+            node = node.parent
+        return node
+
+    def nodesInRange(self, start, end, pid=None, tid=None):
+        """
+        Non kernel nodes starting inside [start, end], in start order per thread.
+        """
+        keys = self.index.keys() if pid is None and tid is None else [(pid, tid)]
         r_list = []
-        r_list.extend(self.top_node.toList())
+        for key in keys:
+            if key not in self.index:
+                continue
+            starts, nodes = self.index[key]
+            r_list.extend(nodes[bisect_left(starts, start) : bisect_right(starts, end)])
         return r_list
 
+    def iterPreorder(self, pid=None, tid=None, skip=None):
+        """
+        Lazy pre-order walk of the whole graph, or of one thread's trees.
+        """
+        for root in self._roots(pid, tid):
+            yield from root.iterPreorder(skip)
+
+    def iterPostorder(self, pid=None, tid=None, skip=None):
+        for root in self._roots(pid, tid):
+            yield from root.iterPostorder(skip)
+
+    def nameSearch(self, name, pid=None, tid=None):
+        return [node for node in self.iterPreorder(pid, tid) if name in node.name]
+
+    def toList(self, pid=None, tid=None):
+        return list(self.iterPreorder(pid, tid))
+
     def getNames(self, no_kernels=False, name_changer=None):
-        r_list = []
-        r_list.extend(self.top_node.getNames(no_kernels, name_changer))
-        return r_list
+        return self.top_node.getNames(no_kernels, name_changer)
 
     def rollupKernelTime(self):
         # TODO: Make a depth arg for how many levels to roll up
+        self._table = None
         self.top_node.rollupKernelTime()
 
     def allKernels(self):
@@ -0,0 +1,431 @@
+import codecs
+import json
+import os
+import re
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from trace_graph import KERNEL_CATEGORIES
+from trace_utils import pausedGC
+
+# Size of the blocks read from the trace file
+CHUNK_SIZE = 1 << 20
+
+# Bump when the parsing or graph building changes, invalidates the cached graphs
+PARSER_VERSION = 1
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Stream:
+    """
+    Minimal incremental JSON reader over a text file.
+    Only keeps a small window of the file in memory; values are decoded one at a time
+    with json.JSONDecoder.raw_decode.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        # Bytes (in UTF-8) read before self.buf
+        self.offset = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += len(self.buf[: self.pos].encode("utf-8"))
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def mark(self):
+        # Cheap handle on the current position, byteOffset converts it
+        return self.offset, self.buf, self.pos
+
+    @staticmethod
+    def byteOffset(mark):
+        offset, buf, pos = mark
+        return offset + len(buf[:pos].encode("utf-8"))
+
+    def tell(self):
+        # Byte offset of the current position, from where the stream started
+        return self.byteOffset(self.mark())
+
+    def peek(self):
+        # Next non whitespace character, "" at the end of the file
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        c = self.peek()
+        if c == "" or c not in chars:
+            raise ValueError(f"Malformed trace: expected one of '{chars}' got '{c}'")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer might continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+class _ByteRange:
+    """
+    Text reader over the bytes [start, end) of a binary file.
+    """
+
+    def __init__(self, f, start, end):
+        f.seek(start)
+        self.f = f
+        self.left = end - start
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def read(self, size):
+        data = self.f.read(min(size, self.left))
+        self.left -= len(data)
+        return self.decoder.decode(data, final=not data)
+
+
+def _iterArray(stream):
+    stream.expect("[")
+    if stream.peek() == "]":
+        stream.pos += 1
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(",]") == "]":
+            return
+
+
+def iterTraceEvents(file_name, chunk_size=CHUNK_SIZE):
+    """
+    Yields the events of a chrome trace one at a time without loading the whole file.
+    Supports both the object format ({"traceEvents": [...], ...}) and the array format.
+    """
+    with open(file_name, encoding="utf-8") as f:
+        stream = _Stream(f, chunk_size)
+        if stream.peek() == "[":
+            yield from _iterArray(stream)
+            return
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "traceEvents":
+                yield from _iterArray(stream)
+            else:
+                # Other top level entries (deviceProperties, metadata...) are not used
+                stream.value()
+            if stream.expect(",}") == "}":
+                return
+
+
+_MARKER = re.compile(r"(?:iteration|ProfilerStep#)(\d+)")
+
+# correlation links kernels to the runtime/HIP call that launched them
+OpRecord = namedtuple("OpRecord", "name ts dur cat pid tid args correlation")
+FlowRecord = namedtuple("FlowRecord", "ph ts id pid tid")
+
+
+class ParsedTrace:
+    """
+    Everything processJson needs from a trace, gathered in a single streaming pass.
+    Events are kept slimmed down. With an iteration, once the markers of its window
+    have been seen only the events buildGraph uses for that window are kept: ops
+    inside it, kernels and flow events from its start on. With a window the events
+    are filtered on it from the start instead.
+    """
+
+    def __init__(self, iteration=None, num_iterations=1, window=None):
+        self.ops = []
+        self.kernels = []
+        self.flows = []
+        # Iteration number -> timestamp of its "iteration#"/"ProfilerStep#" marker
+        self.markers = {}
+        # Correlation ids of the ops dropped for being outside the window
+        self.dropped_correlations = set()
+        self.iteration = iteration
+        self.num_iterations = num_iterations
+        self.window = window
+        self.fixed_window = window is not None
+        # Every event of this (start, end) window is kept, see covers
+        self.kept = window or (float("-inf"), float("inf"))
+
+    def add(self, event):
+        name = event.get("name")
+        if isinstance(name, str) and ("iteration" in name or "ProfilerStep#" in name):
+            match = _MARKER.search(name)
+            if match and "ts" in event:
+                self.markers[int(match.group(1))] = int(event["ts"])
+                self._updateWindow()
+
+        if event.keys() >= {"name", "ts", "dur", "args"}:
+            args = event["args"]
+            record = OpRecord(
+                sys.intern(name),
+                int(event["ts"]),
+                int(event["dur"]),
+                sys.intern(event.get("cat", "")),
+                event.get("pid"),
+                event.get("tid"),
+                {"Input Dims": args["Input Dims"]} if "Input Dims" in args else None,
+                args.get("correlation"),
+            )
+            if record.cat in KERNEL_CATEGORIES:
+                if self.window is None or record.ts >= self.window[0]:
+                    self.kernels.append(record)
+            # The "hints" from amd side would count twice
+            elif "UserMarker" not in args.get("desc", ""):
+                if self.window is None or self.window[0] <= record.ts <= self.window[1]:
+                    self.ops.append(record)
+                elif record.correlation is not None:
+                    self.dropped_correlations.add(record.correlation)
+        elif (event.keys() >= {"name", "ts", "cat", "ph"}) and (
+            event["ph"] in ("f", "s")
+        ):
+            ts = int(event["ts"])
+            if self.window is None or ts >= self.window[0]:
+                self.flows.append(
+                    FlowRecord(
+                        event["ph"], ts, event["id"], event.get("pid"), event.get("tid")
+                    )
+                )
+
+    def _updateWindow(self):
+        # Called on every marker, filters the records once both window markers are known
+        if self.iteration is None or self.fixed_window:
+            return
+        end_iteration = self.iteration + self.num_iterations
+        if self.iteration not in self.markers or end_iteration not in self.markers:
+            return
+        window = self.getIterationTimes(self.iteration, self.num_iterations)
+        if window == self.window:
+            return
+        # A marker seen again can move the window to events already dropped, kept is
+        # then narrowed so that covers tells and the file is parsed again
+        self.window = window
+        self.kept = (max(self.kept[0], window[0]), min(self.kept[1], window[1]))
+        start, end = window
+        ops = []
+        for record in self.ops:
+            if start <= record.ts <= end:
+                ops.append(record)
+            elif record.correlation is not None:
+                self.dropped_correlations.add(record.correlation)
+        self.ops = ops
+        self.kernels = [record for record in self.kernels if record.ts >= start]
+        self.flows = [record for record in self.flows if record.ts >= start]
+
+    def covers(self, start, end):
+        """
+        Whether every event buildGraph needs for the window [start, end] was kept.
+        """
+        return start >= self.kept[0] and end <= self.kept[1]
+
+    def toColumns(self):
+        """
+        Compact picklable copy, one tuple per record field. See extend.
+        """
+        return (
+            tuple(zip(*self.ops)),
+            tuple(zip(*self.kernels)),
+            tuple(zip(*self.flows)),
+            self.markers,
+            self.dropped_correlations,
+            self.kept,
+        )
+
+    def extend(self, columns):
+        """
+        Appends the records of a toColumns() copy, as if its events came next.
+        """
+        ops, kernels, flows, markers, dropped_correlations, kept = columns
+        self.ops.extend(map(OpRecord._make, zip(*ops)))
+        self.kernels.extend(map(OpRecord._make, zip(*kernels)))
+        self.flows.extend(map(FlowRecord._make, zip(*flows)))
+        self.dropped_correlations.update(dropped_correlations)
+        self.kept = (max(self.kept[0], kept[0]), min(self.kept[1], kept[1]))
+        self.markers.update(markers)
+        self._updateWindow()
+
+    def getIterationTimes(self, iteration, num_iterations=1):
+        starting_time = self.markers.get(iteration, 0)
+        ending_time = self.markers.get(iteration + num_iterations, float("inf"))
+        return starting_time, ending_time
+
+
+def parseTrace(file_name, workers=None, iteration=None, num_iterations=1):
+    """
+    ParsedTrace of a file, with workers > 1 the traceEvents array is split in byte
+    ranges parsed in that many processes (see parseTraceChunked).
+    With an iteration only the events of its window are kept. If a marker seen late
+    moved the window to events already dropped the file is parsed a second time,
+    with the final window.
+    """
+    trace = _parseTrace(file_name, workers, ParsedTrace(iteration, num_iterations))
+    if iteration is not None:
+        window = trace.getIterationTimes(iteration, num_iterations)
+        if not trace.covers(*window):
+            trace = _parseTrace(
+                file_name, workers, ParsedTrace(iteration, num_iterations, window)
+            )
+    return trace
+
+
+def _parseTrace(file_name, workers, trace):
+    if workers is not None and workers > 1:
+        return parseTraceChunked(file_name, workers, trace)
+    with pausedGC():
+        for event in iterTraceEvents(file_name):
+            trace.add(event)
+    return trace
+
+
+# Event boundary candidate: the "{" of the next event after a ",". A '"' can't follow
+# a "{" inside a string (it would be escaped), only nested objects give false hits.
+_BOUNDARY = re.compile(rb',\s*(\{)\s*"')
+
+
+def _eventsStart(file_name):
+    """
+    Byte offset of the first event of the traceEvents array, None if there is none.
+    """
+    with open(file_name, "rb") as f:
+        stream = _Stream(_ByteRange(f, 0, os.path.getsize(file_name)))
+        if stream.peek() != "[":
+            stream.expect("{")
+            if stream.peek() == "}":
+                return None
+            while True:
+                key = stream.value()
+                stream.expect(":")
+                if key == "traceEvents":
+                    break
+                stream.value()
+                if stream.expect(",}") == "}":
+                    return None
+        stream.expect("[")
+        if stream.peek() == "]":
+            return None
+        return stream.tell()
+
+
+def _nextBoundary(f, offset, size):
+    # First boundary candidate at or after offset, size if there is none
+    f.seek(offset)
+    while offset < size:
+        block = f.read(CHUNK_SIZE)
+        match = _BOUNDARY.search(block)
+        if match:
+            return offset + match.start(1)
+        # Keep a few bytes, a boundary might straddle two blocks
+        offset += max(len(block) - 64, 1)
+        f.seek(offset)
+    return size
+
+
+def _parseRange(file_name, start, end, iteration=None, num_iterations=1, window=None):
+    """
+    Parses the events starting in the byte range [start, end). Returns the records
+    as ParsedTrace.toColumns(), the offset where parsing stopped and whether the end
+    of the traceEvents array was reached. If end is not an event boundary the last
+    event is cut and parsing stops at its start.
+    """
+    trace = ParsedTrace(iteration, num_iterations, window)
+    done = False
+    with open(file_name, "rb") as f, pausedGC():
+        stream = _Stream(_ByteRange(f, start, end))
+        while True:
+            c = stream.peek()
+            stop = stream.mark()
+            if c == "":
+                break
+            try:
+                event = stream.value()
+            except json.JSONDecodeError:
+                break
+            if stream.peek() == "":
+                # Can't tell if the event is followed by "," or "]", parsed again later
+                break
+            trace.add(event)
+            if stream.expect(",]") == "]":
+                done = True
+                stop = stream.mark()
+                break
+    return trace.toColumns(), start + stream.byteOffset(stop), done
+
+
+def parseTraceChunked(file_name, workers, trace=None):
+    """
+    Parallel parseTrace. The traceEvents array is cut in workers byte ranges at
+    ', {"' sequences, which are only guesses of event boundaries (they could start a
+    nested object). Every range is parsed in a worker with ParsedTrace.add, so the
+    same filtering as the serial path applies, and the records are merged in file
+    order. A range is only used if it starts where the previous one stopped,
+    otherwise it is parsed again from there, so the result is always the same
+    as parsing the file serially. The records are added to trace, a new ParsedTrace
+    by default, and filtered on its iteration window.
+    """
+    size = os.path.getsize(file_name)
+    first = _eventsStart(file_name)
+    if trace is None:
+        trace = ParsedTrace()
+    # The ranges are filtered on the same window as trace
+    window_args = (
+        trace.iteration,
+        trace.num_iterations,
+        trace.window if trace.fixed_window else None,
+    )
+    if first is None:
+        return trace
+
+    with open(file_name, "rb") as f:
+        starts = [first]
+        for i in range(1, workers):
+            start = _nextBoundary(f, first + (size - first) * i // workers, size)
+            if start > starts[-1] and start < size:
+                starts.append(start)
+    ends = starts[1:] + [size]
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(starts))) as pool, pausedGC():
+        futures = [
+            pool.submit(_parseRange, file_name, start, end, *window_args)
+            for start, end in zip(starts, ends)
+        ]
+        stop = first
+        for start, end, future in zip(starts, ends, futures):
+            if start == stop:
+                columns, stop, done = future.result()
+            else:
+                # The previous range did not end on this guess, it was not a boundary
+                future.cancel()
+                columns, stop, done = _parseRange(file_name, stop, end, *window_args)
+            trace.extend(columns)
+            if done:
+                break
+    if not done:
+        raise ValueError(f"Malformed trace: traceEvents array not closed in {file_name}")
+    return trace
@@ -0,0 +1,142 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+from trace_graph import KERNEL_CATEGORIES
+from trace_reader import ParsedTrace, _MARKER
+from trace_utils import pausedGC
+
+# No upper bound on the raw (ns) start of the window
+NO_END = (1 << 63) - 1
+
+# Same ops as rpd2tracing.py, with the time window pushed into the WHERE on the raw
+# start columns. Kernels can run after the window, so they are kept as long as the
+# api that launched them is in the window.
+_OPS_QUERY = """
+SELECT A.string, B.string, gpuId, queueId, rocpd_op.start/1000,
+    (rocpd_op.end - rocpd_op.start)/1000, rocpd_api_ops.api_id,
+    rocpd_api.start < :start
+FROM rocpd_op
+INNER JOIN rocpd_string A ON A.id = rocpd_op.opType_id
+INNER JOIN rocpd_string B ON B.id = rocpd_op.description_id
+LEFT JOIN rocpd_api_ops ON rocpd_api_ops.op_id = rocpd_op.id
+LEFT JOIN rocpd_api ON rocpd_api.id = rocpd_api_ops.api_id
+WHERE rocpd_op.start >= :start AND (rocpd_op.start < :end OR rocpd_api.start < :end)
+ORDER BY rocpd_op.id
+"""
+
+_APIS_QUERY = """
+SELECT A.string, B.string, pid, tid, rocpd_api.start/1000,
+    (rocpd_api.end - rocpd_api.start)/1000, rocpd_api.end != rocpd_api.start, rocpd_api.id
+FROM rocpd_api
+INNER JOIN rocpd_string A ON A.id = rocpd_api.apiName_id
+INNER JOIN rocpd_string B ON B.id = rocpd_api.args_id
+WHERE rocpd_api.start >= :start AND rocpd_api.start < :end
+ORDER BY rocpd_api.id
+"""
+
+_HSA_QUERY = """
+SELECT A.string, B.string, pid, tid, rocpd_hsaApi.start/1000,
+    (rocpd_hsaApi.end - rocpd_hsaApi.start)/1000
+FROM rocpd_hsaApi
+INNER JOIN rocpd_string A ON A.id = rocpd_hsaApi.apiName_id
+INNER JOIN rocpd_string B ON B.id = rocpd_hsaApi.args_id
+WHERE rocpd_hsaApi.start >= :start AND rocpd_hsaApi.start < :end
+ORDER BY rocpd_hsaApi.id
+"""
+
+_MARKERS_QUERY = """
+SELECT B.string, rocpd_api.start/1000
+FROM rocpd_api
+INNER JOIN rocpd_string A ON A.id = rocpd_api.apiName_id AND A.string = 'UserMarker'
+INNER JOIN rocpd_string B ON B.id = rocpd_api.args_id
+WHERE B.string LIKE '%iteration%' OR B.string LIKE '%ProfilerStep#%'
+ORDER BY rocpd_api.id
+"""
+
+
+def parseRpd(file_name, iteration=None, num_iterations=1):
+    """
+    ParsedTrace straight from a rocprofiler .rpd (SQLite) file, without going through
+    rpd2tracing.py and JSON. Rows are turned into the events rpd2tracing.py writes and
+    go through ParsedTrace.add, so the same filtering rules apply. Differences:
+    - Only the events of the iteration window are read, the window comes from the
+      "iteration#"/"ProfilerStep#" UserMarkers.
+    - Kernels are linked through rocpd_api_ops (the "correlation"), kernels launched
+      before the window, flow events and the UserMarker GPU frames are left out.
+    """
+    # as_uri escapes the "?", "#" and "%" that would end or break a plain file: URI
+    uri = Path(file_name).resolve().as_uri() + "?mode=ro"
+    with closing(sqlite3.connect(uri, uri=True)) as connection:
+        trace = ParsedTrace()
+        with pausedGC():
+            for label, ts in connection.execute(_MARKERS_QUERY):
+                match = _MARKER.search(label.replace('"', ""))
+                if match:
+                    trace.markers[int(match.group(1))] = ts
+
+            # The window only comes from the UserMarkers, not from ops with a similar name
+            markers = dict(trace.markers)
+            window = {"start": 0, "end": NO_END}
+            if iteration is not None:
+                starting_time, ending_time = trace.getIterationTimes(
+                    iteration, num_iterations
+                )
+                window["start"] = starting_time * 1000
+                if ending_time != float("inf"):
+                    window["end"] = (ending_time + 1) * 1000
+
+            for op_type, desc, gpu, queue, ts, dur, api_id, early in connection.execute(
+                _OPS_QUERY, window
+            ):
+                if op_type in ("KernelExecution", "CopyDeviceToDevice"):
+                    cat = "Kernel"
+                else:
+                    cat = op_type
+                if early and cat in KERNEL_CATEGORIES:
+                    # Launched before the window, it would not be linked to anything
+                    continue
+                trace.add(
+                    {
+                        "pid": str(gpu),
+                        "tid": str(queue),
+                        "name": op_type if len(desc) == 0 else desc,
+                        "ts": ts,
+                        "dur": dur,
+                        "cat": cat,
+                        "args": {"desc": op_type, "correlation": api_id},
+                    }
+                )
+
+            for api, args, pid, tid, ts, dur, has_duration, api_id in connection.execute(
+                _APIS_QUERY, window
+            ):
+                args = args.replace('"', "")
+                if api == "UserMarker":
+                    if not has_duration:
+                        # Instantaneous marks are only used for the iteration markers
+                        continue
+                    event = {"name": args, "args": {"desc": args}}
+                else:
+                    event = {"name": api, "args": {"desc": args, "correlation": api_id}}
+                event.update(pid=str(pid), tid=str(tid), ts=ts, dur=dur)
+                trace.add(event)
+
+            try:
+                hsa_apis = connection.execute(_HSA_QUERY, window).fetchall()
+            except sqlite3.OperationalError:
+                # Older rpd files have no HSA api table
+                hsa_apis = []
+            for api, args, pid, tid, ts, dur in hsa_apis:
+                trace.add(
+                    {
+                        "pid": str(pid),
+                        "tid": str(tid + 1),
+                        "name": api,
+                        "ts": ts,
+                        "dur": dur,
+                        "args": {"desc": args.replace('"', "")},
+                    }
+                )
+            trace.markers = markers
+    return trace
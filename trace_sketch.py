@@ -0,0 +1,109 @@
+import math
+
+# Default relative accuracy of the quantiles, 0.01 means within 1% of the true value
+RELATIVE_ACCURACY = 0.01
+# Bound on the number of buckets kept per sketch, with the default accuracy 2048
+# buckets cover durations from 1 up to ~10^17 so collapsing almost never happens
+MAX_BUCKETS = 2048
+
+
+class QuantileSketch:
+    """
+    Bounded memory quantile sketch (DDSketch) of non negative durations.
+    Values are counted in logarithmic buckets so any quantile is returned within
+    relative_accuracy of a value of the right rank, total, count, min and max are exact.
+    Sketches with the same relative_accuracy can be merged, e.g. per trace shard or
+    rank, without the original values.
+    If more than max_buckets are needed the lowest buckets are collapsed together,
+    which only loses accuracy on the smallest values.
+    """
+
+    __slots__ = (
+        "relative_accuracy",
+        "max_buckets",
+        "gamma",
+        "_log_gamma",
+        "buckets",
+        "zeros",
+        "count",
+        "total",
+        "min",
+        "max",
+    )
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY, max_buckets=MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # Bucket i counts the values in (gamma^(i-1), gamma^i]
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, count=1):
+        self.count += count
+        self.total += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += count
+            return
+        i = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[i] = self.buckets.get(i, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Can only merge sketches with the same relative accuracy")
+        for i, count in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+        return self
+
+    def _collapse(self):
+        keys = sorted(self.buckets)
+        extra = keys[: len(keys) - self.max_buckets + 1]
+        self.buckets[extra[-1]] += sum(self.buckets.pop(i) for i in extra[:-1])
+
+    def quantile(self, q):
+        """
+        Value at quantile q (0 <= q <= 1), interpolated between the closest ranks like
+        trace_utils.getPercentile.
+        """
+        if self.count == 0:
+            return None
+        pos = q * (self.count - 1)
+        lo = int(pos)
+        hi = min(lo + 1, self.count - 1)
+        lo_value, hi_value = self._values((lo, hi))
+        return lo_value + (hi_value - lo_value) * (pos - lo)
+
+    def _values(self, ranks):
+        # Estimated values of the given sorted 0 based ranks
+        values = []
+        seen = self.zeros
+        buckets = iter(sorted(self.buckets.items()))
+        value = max(self.min, 0)
+        for rank in ranks:
+            while seen <= rank:
+                i, count = next(buckets)
+                seen += count
+                value = 2 * self.gamma**i / (self.gamma + 1)
+            values.append(min(max(value, self.min), self.max))
+        return values
+
+    def __len__(self):
+        return len(self.buckets)
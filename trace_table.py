@@ -0,0 +1,137 @@
+try:
+    import numpy as np
+except ImportError:
+    # The columnar backend is optional, without NumPy the analyses walk the tree.
+    np = None
+
+HAVE_NUMPY = np is not None
+
+
+class EventTable:
+    """
+    Columnar copy of a Graph, one row per node in pre-order (row 0 is the top node).
+    start, dur, parent (row of the parent, -1 for the top node), cat (category code),
+    name_id and is_kernel are NumPy arrays; names is the string table of name_id and
+    nodes maps each row back to its Node.
+    """
+
+    def __init__(self, nodes, parents):
+        name_ids = {}
+        self.nodes = nodes
+        self.start = np.array([n.start for n in nodes], np.int64)
+        self.dur = np.array([n.duration for n in nodes], np.int64)
+        self.parent = np.array(parents, np.int64)
+        self.cat = np.array([n.cat_code for n in nodes], np.int32)
+        self.is_kernel = np.array([n.is_kernel for n in nodes], np.bool_)
+        self.name_id = np.array(
+            [name_ids.setdefault(n.name, len(name_ids)) for n in nodes], np.int64
+        )
+        self.names = list(name_ids)
+
+    @classmethod
+    def fromGraph(cls, graph):
+        nodes = []
+        parents = []
+        stack = [graph.top_node]
+        parent_stack = [-1]
+        while stack:
+            node = stack.pop()
+            parents.append(parent_stack.pop())
+            if node.children:
+                stack.extend(reversed(node.children))
+                parent_stack.extend([len(nodes)] * len(node.children))
+            nodes.append(node)
+        return cls(nodes, parents)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def groupIds(self, name_changer=None):
+        """
+        Group of every row after applying name_changer to the names, and the group
+        names. name_changer only runs once per distinct name.
+        """
+        if name_changer is None:
+            return self.name_id, list(self.names)
+        group_names = {}
+        groups = self.mapNames(
+            lambda name: group_names.setdefault(name_changer(name), len(group_names))
+        )
+        return groups, list(group_names)
+
+    def groupTotals(self, name_changer=None):
+        """
+        Group names and the total duration of each group, nothing is sorted.
+        """
+        groups, group_names = self.groupIds(name_changer)
+        totals = np.zeros(len(group_names), np.int64)
+        np.add.at(totals, groups, self.dur)
+        return group_names, totals.tolist()
+
+    def groupedDurations(self, name_changer=None, only=None):
+        """
+        Durations sorted by group then value. Returns the group names, the sorted
+        durations and the [first, last) bounds of each group in them.
+        With only, just the groups with these names are kept (and sorted).
+        """
+        groups, group_names = self.groupIds(name_changer)
+        dur = self.dur
+        if only is not None:
+            # The rows of the other groups are dropped once, only the rest is sorted
+            only = set(only)
+            wanted = np.array([name in only for name in group_names], bool)
+            rows = wanted[groups]
+            groups = groups[rows]
+            dur = dur[rows]
+        if len(dur) == 0:
+            return [], dur, np.zeros(0, np.int64), np.zeros(0, np.int64)
+        order = np.lexsort((dur, groups))
+        durations = dur[order]
+        sorted_groups = groups[order]
+        firsts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        lasts = np.r_[firsts[1:], len(durations)]
+        return [group_names[g] for g in sorted_groups[firsts]], durations, firsts, lasts
+
+    def groupStats(self, name_changer=None, only=None):
+        """
+        Group names followed by the total, max, min, median, count, p90 and p99 of
+        each group's durations, all as lists. only limits it to some group names.
+        """
+        names, durations, firsts, lasts = self.groupedDurations(name_changer, only)
+        counts = lasts - firsts
+
+        def percentile(q):
+            # Same linear interpolation as trace_utils.getPercentile
+            pos = firsts + q * (counts - 1)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo + 1, lasts - 1)
+            return (durations[lo] + (durations[hi] - durations[lo]) * (pos - lo)).tolist()
+
+        # Median as in getMedian: mean of the two middle values
+        low_mid = durations[firsts + (counts - 1) // 2]
+        high_mid = durations[firsts + counts // 2]
+        return (
+            names,
+            np.add.reduceat(durations, firsts).tolist(),
+            durations[lasts - 1].tolist(),
+            durations[firsts].tolist(),
+            ((low_mid + high_mid) / 2).tolist(),
+            counts.tolist(),
+            percentile(0.9),
+            percentile(0.99),
+        )
+
+    def mapNames(self, name_fn):
+        """
+        Integer name_fn(name) of every row, name_fn only runs once per distinct name.
+        """
+        per_name = np.fromiter(
+            (name_fn(name) for name in self.names), np.int64, len(self.names)
+        )
+        return per_name[self.name_id]
+
+    def sumBy(self, keys, count):
+        """
+        Total duration of the rows with each key in range(count).
+        """
+        return [int(self.dur[keys == k].sum()) for k in range(count)]
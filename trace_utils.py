@@ -1,5 +1,8 @@
+import gc
 import re
 import json
+from collections import namedtuple
+from contextlib import contextmanager
 
 # Constants
 MICROSECOND_TO_SECOND = 0.000001
@@ -7,6 +10,10 @@ TO_GB = 1000000000
 TWO_LOAD_ONE_STORE = 3
 ONE_LOAD_ONE_STORE = 2
 
+# Per op statistics, the first five are the columns of the reports
+OpSummary = namedtuple("OpSummary", "total max min median count p90 p99")
+SUMMARY_COLUMNS = 5
+
 
 def calcAllBW(graph):
     kernels = graph.nameSearch("elementwise_kernel")
@@ -24,17 +31,15 @@ def calcAllBW(graph):
         launcher = kernel.parent.parent
 
         # Get size of the inputs
-        if ("args" in launcher.traceEvent) and (
-            "Input Dims" in launcher.traceEvent["args"]
-        ):
-            sizes = launcher.traceEvent["args"]["Input Dims"]
+        if launcher.args is not None and "Input Dims" in launcher.args:
+            sizes = launcher.args["Input Dims"]
         else:
             # RPD... Get the size out of the name
             # TODO: Makes sure all our assumtions about the name are there...
 
             match = re.search(".* sizes = (.*), input_op_ids.*", launcher.name)
             sizes = json.loads(match.group(1))
-            launcher.traceEvent["args"]["Input Dims"] = sizes
+            launcher.args = {"Input Dims": sizes}
 
         # Get Op type
         if "CUDAFunctor_add" in kernel.name:
@@ -45,7 +50,7 @@ def calcAllBW(graph):
             data_transfer_persec = data_transfer / (
                 kernel.duration * MICROSECOND_TO_SECOND
             )
-            kernel.traceEvent["BW"] = data_transfer_persec
+            kernel.bw = data_transfer_persec
         elif "BinaryFunctor" in kernel.name:
             if "MulFunctor" in kernel.name:
                 # TODO: Support N dimentional MulFunctors
@@ -63,7 +68,7 @@ def calcAllBW(graph):
                 data_transfer_persec = data_transfer / (
                     kernel.duration * MICROSECOND_TO_SECOND
                 )
-                kernel.traceEvent["BW"] = data_transfer_persec
+                kernel.bw = data_transfer_persec
             else:
                 # Generic Binary function
                 # print(
@@ -78,7 +83,7 @@ def calcAllBW(graph):
                 data_transfer_persec = data_transfer / (
                     kernel.duration * MICROSECOND_TO_SECOND
                 )
-                kernel.traceEvent["BW"] = data_transfer_persec
+                kernel.bw = data_transfer_persec
         elif "BUnaryFunctor" in kernel.name:
             if "MulFunctor" in kernel.name:
                 # TODO: Support N dimentional MulFunctors
@@ -91,7 +96,7 @@ def calcAllBW(graph):
                 data_transfer_persec = data_transfer / (
                     kernel.duration * MICROSECOND_TO_SECOND
                 )
-                kernel.traceEvent["BW"] = data_transfer_persec
+                kernel.bw = data_transfer_persec
             else:
                 dims_multiplied = 1
                 for n in sizes[0]:
@@ -102,7 +107,7 @@ def calcAllBW(graph):
                 data_transfer_persec = data_transfer / (
                     kernel.duration * MICROSECOND_TO_SECOND
                 )
-                kernel.traceEvent["BW"] = data_transfer_persec
+                kernel.bw = data_transfer_persec
 
         else:
             print(f"Not Implemented \n name: {kernel.name}")
@@ -118,3 +123,43 @@ def getMedian(nums):
     nums.sort()
     mid = len(nums) // 2
     return (nums[mid] + nums[~mid]) / 2
+
+
+def getPercentile(sorted_nums, q):
+    # Linear interpolation between closest ranks, q=0.5 gives the same as getMedian
+    pos = q * (len(sorted_nums) - 1)
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_nums) - 1)
+    return sorted_nums[lo] + (sorted_nums[hi] - sorted_nums[lo]) * (pos - lo)
+
+
+def summarizeDurations(durations):
+    """
+    OpSummary of a list of durations, sorts it in place.
+    """
+    durations.sort()
+    return OpSummary(
+        sum(durations),
+        durations[-1],
+        durations[0],
+        getMedian(durations),
+        len(durations),
+        getPercentile(durations, 0.9),
+        getPercentile(durations, 0.99),
+    )
+
+
+@contextmanager
+def pausedGC():
+    """
+    Disables the cyclic garbage collector inside the block. Nothing can be collected
+    while millions of records/nodes are created, but the passes they trigger would
+    take a large part of the time.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()